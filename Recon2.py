@@ -1,29 +1,16 @@
 import streamlit as st
 import os
-import zipfile
-import tempfile
-from pathlib import Path
-from PIL import Image
-try:
-    import pillow_heif
-    pillow_heif.register_heif_opener()
-    HEIF_SUPPORT = True
-    st.write("[INFO] pillow-heif успешно загружен, поддержка HEIC/HEIF активна.")
-except ImportError:
-    HEIF_SUPPORT = False
-    st.warning("Для поддержки HEIC/HEIF установите пакет pillow-heif: pip install pillow-heif")
-import shutil
-from io import BytesIO
-import requests
+import json
 import uuid
-from rename import process_rename_mode
-from convers import process_convert_mode
-from water import process_watermark_mode
-from utils import filter_large_files, SUPPORTED_EXTS
-
-pillow_heif.register_heif_opener()
+# Здесь только лёгкие модули: кодеки (PIL, pillow-heif), модули режимов и сетевой клиент
+# импортируются там, где они нужны, — на холодном старте и при каждом перезапуске скрипта
+# не тратится время на то, чем текущий режим не пользуется
+from jobs import load_state, load_log, resume_job, cleanup_stale_jobs, FINISHED
+from utils import heif_available, MAX_WORKERS, session_dir, remove_session_dir, cleanup_stale_sessions
 
 st.set_page_config(page_title="PhotoFlow: Умная обработка изображений", page_icon="📸")
+if not heif_available():
+    st.warning("Для поддержки HEIC/HEIF установите пакет pillow-heif: pip install pillow-heif")
 st.markdown("""
 <style>
     body, .stApp {
@@ -91,6 +78,32 @@ with st.expander("ℹ️ Инструкция и ответы на вопрос
       Попробуйте уменьшить размер архива или разделить файлы на несколько частей.
     """)
 
+# Режимы заданий и их названия в интерфейсе
+MODE_LABELS = {
+    "rename": "Переименование фото", "convert": "Конвертация в JPG", "watermark": "Водяной знак",
+    "combined": "Всё сразу",
+}
+# Порядок нумерации при переименовании
+ORDER_LABELS = {"name": "По имени файла", "date": "По времени съёмки (EXIF, иначе время файла)"}
+# Выходы комбинированного режима в интерфейсе
+OUTPUT_LABELS = {
+    "original": "Исходники (переименованные)",
+    "convert": "JPG",
+    "watermark": "JPG с водяным знаком",
+    "thumbnail": "Миниатюры для веба",
+}
+
+if "session_id" not in st.session_state:
+    # Новая сессия: заодно удаляем архивы давно закрытых сессий
+    st.session_state["session_id"] = uuid.uuid4().hex
+    cleanup_stale_sessions()
+    cleanup_stale_jobs()
+if "job_id" not in st.session_state:
+    # Задание, запущенное до закрытия вкладки, продолжается по ссылке с ?job=<ID>
+    st.session_state["job_id"] = st.query_params.get("job")
+    job_state = load_state(st.session_state["job_id"]) if st.session_state["job_id"] else None
+    if job_state:
+        st.session_state["mode"] = MODE_LABELS.get(job_state["mode"], "Переименование фото")
 if "reset_uploader" not in st.session_state:
     st.session_state["reset_uploader"] = 0
 if "log" not in st.session_state:
@@ -102,19 +115,67 @@ if "stats" not in st.session_state:
 if "mode" not in st.session_state:
     st.session_state["mode"] = "Переименование фото"
 
+def discard_result():
+    st.session_state.update({"log": [], "result_zip": None, "stats": {}, "job_id": None, "resumable_job": None})
+    st.query_params.pop("job", None)
+    remove_session_dir(st.session_state["session_id"])
+
 def reset_all():
+    remove_session_dir(st.session_state["session_id"])
     st.session_state["reset_uploader"] += 1
     st.session_state["log"] = []
     st.session_state["result_zip"] = None
     st.session_state["stats"] = {}
+    st.session_state["job_id"] = None
+    st.session_state["resumable_job"] = None
+    st.query_params.pop("job", None)
     st.session_state["mode"] = "Переименование фото"
 
+def apply_job_result(state):
+    """Переносит результат завершённого задания в session_state для блока скачивания."""
+    st.session_state["job_id"] = None
+    st.session_state["log"] = load_log(state["id"])
+    st.session_state["stats"] = state.get("stats") or {}
+    st.session_state["result_zip"] = state.get("result_zip") if state["status"] == "done" else None
+    if state["status"] == "error":
+        st.session_state["job_error"] = state.get("error")
+        # Готовые изображения остались в папке задания — его можно продолжить с места остановки
+        st.session_state["resumable_job"] = state["id"] if state.get("resumable") else None
+
+def resume_failed_job():
+    job_id = st.session_state.pop("resumable_job", None)
+    if job_id and resume_job(job_id):
+        st.session_state.update({"job_id": job_id, "log": [], "stats": {}})
+    else:
+        st.session_state["job_error"] = "Задание нельзя продолжить: его файлы уже удалены."
+
+@st.fragment(run_every=1.0)
+def job_progress(job_id):
+    """Опрашивает состояние фонового задания; после завершения перезапускает страницу целиком."""
+    state = load_state(job_id)
+    if state is None or state["status"] in FINISHED:
+        st.rerun()
+    if state["status"] == "queued":
+        st.info("⏳ Задание в очереди: ждём свободных процессов обработки...")
+    else:
+        done, total = state.get("done", 0), state.get("total", 0)
+        st.progress(done / total if total else 0.0, text=f"Обработано: {done}/{total}")
+    st.caption("Обработка идёт на сервере: страницу можно обновить или закрыть и вернуться по этой же ссылке.")
+
+# Завершённое фоновое задание переносится в сессию до отрисовки виджетов (в том числе режима)
+if st.session_state.get("job_id"):
+    job_state = load_state(st.session_state["job_id"])
+    if job_state is None:
+        st.session_state["job_id"] = None
+    elif job_state["status"] in FINISHED:
+        apply_job_result(job_state)
+
 mode = st.radio(
     "Выберите режим работы:",
-    ["Переименование фото", "Конвертация в JPG", "Водяной знак"],
-    index=0 if st.session_state["mode"] == "Переименование фото" else (1 if st.session_state["mode"] == "Конвертация в JPG" else 2),
+    list(MODE_LABELS.values()),
+    index=list(MODE_LABELS.values()).index(st.session_state["mode"]),
     key="mode_radio",
-    on_change=lambda: st.session_state.update({"log": [], "result_zip": None, "stats": {}})
+    on_change=discard_result
 )
 st.session_state["mode"] = mode
 
@@ -132,11 +193,39 @@ uploaded_files = st.file_uploader(
     key=st.session_state["reset_uploader"]
 )
 
-# --- UI для режима Водяной знак ---
-if mode == "Водяной знак":
+workers = MAX_WORKERS
+profile = None
+combined_outputs = []
+rename_order = "name"
+if mode == "Всё сразу":
+    combined_outputs = st.multiselect(
+        "Что получить (каждое фото декодируется один раз, результаты — в папках одного архива):",
+        list(OUTPUT_LABELS), default=["original", "convert", "thumbnail"], format_func=OUTPUT_LABELS.get,
+    )
+    combined_rename = st.checkbox("Переименовать по порядку в каждой папке (1.jpg, 2.jpg, ...)", value=True)
+if mode == "Переименование фото" or (mode == "Всё сразу" and combined_rename):
+    # Время съёмки читается только из заголовков файлов — без декодирования
+    rename_order = st.radio(
+        "Порядок нумерации:", list(ORDER_LABELS), format_func=ORDER_LABELS.get, horizontal=True,
+    )
+if mode in ("Конвертация в JPG", "Водяной знак", "Всё сразу"):
+    from imaging import ENCODE_PROFILES
+    workers = st.sidebar.number_input("Процессов обработки", min_value=1, max_value=MAX_WORKERS, value=MAX_WORKERS)
+    profile_labels = {
+        "archival": "Архивный (максимальное качество)",
+        "web": "Для веба (меньше размер, до 2560 px)",
+        "fast": "Быстрый (без оптимизации)",
+        "thumbnail": "Миниатюра (до 800 px)",
+    }
+    profile = st.sidebar.selectbox("Профиль JPEG", list(ENCODE_PROFILES), format_func=lambda p: profile_labels.get(p, p))
+
+# --- UI для режима Водяной знак (и выхода с водяным знаком в режиме "Всё сразу") ---
+if mode == "Водяной знак" or "watermark" in combined_outputs:
     st.markdown("**Выберите водяной знак (PNG/JPG):**")
     import glob
-    from water import apply_watermark
+    from PIL import Image, ImageColor
+    from imaging import TILE_SPACING, TILE_ANGLE
+    from preview import get_preview_image, save_user_watermark, render_preview
     watermark_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "watermarks"))
     preset_files = []
     if os.path.exists(watermark_dir):
@@ -145,10 +234,8 @@ if mode == "Водяной знак":
     user_wm_file = st.file_uploader("Или загрузите свой PNG/JPG водяной знак", type=["png", "jpg", "jpeg"], key="watermark_upload")
     user_wm_path = None
     if user_wm_file is not None:
-        tmp_dir = tempfile.gettempdir()
-        user_wm_path = os.path.join(tmp_dir, f"user_wm_{user_wm_file.name}")
-        with open(user_wm_path, "wb") as f:
-            f.write(user_wm_file.read())
+        user_wm_path = save_user_watermark(user_wm_file, session_dir(st.session_state["session_id"]))
+    wm_text = st.text_input("Или текст водяного знака (если картинка не выбрана)", "").strip() or None
     st.sidebar.header('Настройки водяного знака')
     opacity = st.sidebar.slider('Прозрачность', 0, 100, 60) / 100.0
     size_percent = st.sidebar.slider('Размер (% от ширины фото)', 5, 80, 25)
@@ -158,6 +245,7 @@ if mode == "Водяной знак":
         'Правый верхний угол',
         'Левый верхний угол',
         'По центру',
+        'Плиткой по диагонали',
     ])
     pos_map = {
         'Правый нижний угол': 'bottom_right',
@@ -165,47 +253,34 @@ if mode == "Водяной знак":
         'Правый верхний угол': 'top_right',
         'Левый верхний угол': 'top_left',
         'По центру': 'center',
+        'Плиткой по диагонали': 'tile',
     }
+    tile_spacing, tile_angle = TILE_SPACING, TILE_ANGLE
+    if pos_map[position] == 'tile':
+        tile_spacing = st.sidebar.slider('Промежуток между знаками (% от размера знака)', 0, 200, int(TILE_SPACING * 100)) / 100.0
+        tile_angle = st.sidebar.slider('Угол наклона, °', -90, 90, int(TILE_ANGLE))
+    text_options = None
+    if wm_text and preset_choice == "Нет" and not user_wm_file:
+        text_color = st.sidebar.color_picker("Цвет текста", "#FFFFFF")
+        text_options = {"color": ImageColor.getrgb(text_color)}
     bg_color = st.sidebar.color_picker("Цвет фона предпросмотра", "#CCCCCC")
 
     # --- Предпросмотр водяного знака ---
     st.markdown("**Предпросмотр водяного знака:**")
-    preview_img = None
-    def get_first_image(uploaded_files):
-        for file in uploaded_files:
-            if file.name.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp', '.webp', '.tiff', '.heic', '.heif')):
-                file.seek(0)
-                try:
-                    return Image.open(file)
-                except Exception:
-                    continue
-            elif file.name.lower().endswith('.zip'):
-                import zipfile
-                from io import BytesIO
-                file.seek(0)
-                with zipfile.ZipFile(file, 'r') as zf:
-                    for name in zf.namelist():
-                        if name.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp', '.webp', '.tiff', '.heic', '.heif')):
-                            with zf.open(name) as imgf:
-                                try:
-                                    return Image.open(BytesIO(imgf.read()))
-                                except Exception:
-                                    continue
-        return None
-    preview_img = get_first_image(uploaded_files) if uploaded_files else None
+    # Уменьшенная копия первого фото: декодируется один раз на загрузку и кэшируется между перезапусками
+    preview_img, preview_key = get_preview_image(uploaded_files) if uploaded_files else (None, None)
     if preview_img is None:
         preview_img = Image.new("RGB", (400, 300), bg_color)
+        preview_key = ("blank", bg_color)
     wm_path = None
     if preset_choice != "Нет":
         wm_path = os.path.join(watermark_dir, preset_choice)
     elif user_wm_file:
-        tmp_dir = tempfile.gettempdir()
-        wm_path = os.path.join(tmp_dir, f"user_wm_{user_wm_file.name}")
-        with open(wm_path, "wb") as f:
-            f.write(user_wm_file.getvalue() if hasattr(user_wm_file, 'getvalue') else user_wm_file.read())
+        wm_path = user_wm_path
     try:
-        if wm_path:
-            preview = apply_watermark(preview_img, watermark_path=wm_path, position=pos_map[position], opacity=opacity, scale=size_percent/100.0)
+        if wm_path or wm_text:
+            preview = render_preview(preview_img, preview_key, wm_path, pos_map[position], opacity, size_percent/100.0,
+                                     tile_spacing, tile_angle, text=wm_text, text_options=text_options)
         else:
             preview = preview_img
         st.image(preview, caption="Предпросмотр", use_container_width=True)
@@ -214,24 +289,62 @@ if mode == "Водяной знак":
 
 # --- Кнопка обработки для режима Переименование фото ---
 if mode == "Переименование фото":
-    process_rename_mode(uploaded_files)
+    from rename import process_rename_mode
+    process_rename_mode(uploaded_files, order=rename_order)
 elif mode == "Конвертация в JPG":
-    process_convert_mode(uploaded_files)
+    from convers import process_convert_mode
+    process_convert_mode(uploaded_files, workers=workers, profile=profile)
 elif mode == "Водяной знак":
-    process_watermark_mode(uploaded_files, preset_choice, user_wm_file, user_wm_path, watermark_dir, pos_map, opacity, size_percent, position)
+    from water import process_watermark_mode
+    process_watermark_mode(uploaded_files, preset_choice, user_wm_file, user_wm_path, watermark_dir, pos_map, opacity, size_percent, position, workers=workers, profile=profile,
+                            tile_spacing=tile_spacing, tile_angle=tile_angle, wm_text=wm_text, text_options=text_options)
+elif mode == "Всё сразу":
+    from combined import process_combined_mode
+    watermark = None
+    if "watermark" in combined_outputs:
+        watermark = {
+            "watermark_path": wm_path, "text": None if wm_path else wm_text, "text_options": text_options,
+            "position": pos_map[position], "opacity": opacity, "scale": size_percent / 100.0,
+            "tile_spacing": tile_spacing, "tile_angle": tile_angle,
+        }
+    process_combined_mode(uploaded_files, combined_outputs, rename=combined_rename, watermark=watermark,
+                          workers=workers, profile=profile, order=rename_order)
+
+# Фоновое задание: пока оно идёт, показываем только прогресс
+job_id = st.session_state.get("job_id")
+if job_id:
+    st.query_params["job"] = job_id
+    st.subheader('Обработка изображений...')
+    job_progress(job_id)
+    st.stop()
+if st.session_state.get("job_error"):
+    st.error(f"Ошибка при обработке: {st.session_state.pop('job_error')}")
+if st.session_state.get("resumable_job"):
+    st.button("▶️ Продолжить обработку с места остановки", on_click=resume_failed_job)
 
 # Универсальный блок скачивания архива и лога для всех режимов
 if st.session_state.get("result_zip"):
     st.success("✅ Архив успешно создан! Готов к скачиванию.")
+    stats = st.session_state.get("stats") or {}
+    if stats.get("converted") == 0:
+        st.error("Не удалось конвертировать ни одного изображения.")
+    if stats.get("bytes_in"):
+        st.caption(
+            f"Профиль {stats['profile']}: {stats['bytes_in'] / 1024 / 1024:.1f} МБ → "
+            f"{stats['bytes_out'] / 1024 / 1024:.1f} МБ, кодирование {stats['encode_time']:.2f} сек"
+        )
+    if stats.get("duplicates"):
+        st.caption(f"Дубликатов обработано один раз: {stats['duplicates']}")
+    if stats.get("archive"):
+        from core import format_archive_stats
+        st.caption(format_archive_stats(stats["archive"]))
     result_zip = st.session_state["result_zip"]
     archive_data = None
     if isinstance(result_zip, bytes):
         archive_data = result_zip
     elif isinstance(result_zip, str) and os.path.exists(result_zip):
-        with open(result_zip, "rb") as f:
-            archive_data = f.read()
-    else:
-        archive_data = None
+        # Архив читается с диска только при нажатии кнопки, а не на каждом перезапуске скрипта
+        archive_data = lambda: open(result_zip, "rb")
     if archive_data:
         st.download_button(
             label="📥 Скачать архив",
@@ -239,7 +352,8 @@ if st.session_state.get("result_zip"):
             file_name=(
                 "renamed_photos.zip" if mode == "Переименование фото"
                 else "converted_photos.zip" if mode == "Конвертация в JPG"
-                else "watermarked_images.zip"
+                else "watermarked_images.zip" if mode == "Водяной знак"
+                else "photos.zip"
             ),
             mime="application/zip",
             type="primary"
@@ -251,6 +365,13 @@ if st.session_state.get("result_zip"):
             file_name="log.txt",
             mime="text/plain"
         )
+        if stats.get("perf"):
+            st.download_button(
+                label="📈 Скачать статистику в .json",
+                data=json.dumps(stats, ensure_ascii=False, indent=2),
+                file_name="stats.json",
+                mime="application/json"
+            )
         st.text_area("Лог:", value="\n".join(st.session_state["log"]), height=300, disabled=True)
 else:
     st.error("❌ Архив не создан. Проверьте формат файлов или попробуйте снова.")
@@ -267,6 +388,8 @@ if st.button("🔄 Начать сначала", type="primary"):
 
 # --- Функция для загрузки на TransferNow ---
 def upload_to_transfernow(file_path):
+    # Сетевой клиент нужен только при загрузке
+    import requests
     url = "https://api.transfernow.net/v2/transfers"
     with open(file_path, 'rb') as f:
         files = {'files': (os.path.basename(file_path), f)}
@@ -0,0 +1,303 @@
+# archive.py
+import os
+import shutil
+import time
+import struct
+import zipfile
+from pathlib import PurePosixPath
+
+# Методы сжатия, которые zipfile умеет записать в центральный каталог
+RAW_COPY_METHODS = (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED, zipfile.ZIP_BZIP2, zipfile.ZIP_LZMA)
+COPY_CHUNK = 1024 * 1024
+# Уже сжатые форматы: повторное сжатие почти ничего не даёт, такие записи хранятся как есть
+STORED_EXTS = ('.jpg', '.jpeg', '.webp', '.heic', '.heif')
+# Уровень DEFLATE для остальных записей (PNG, TIFF, BMP, текст): 1 — быстрее, 9 — плотнее
+DEFLATE_LEVEL = int(os.environ.get("PHOTOFLOW_ZIP_LEVEL", 6))
+
+
+def compression_for(arcname):
+    """Метод сжатия записи по расширению: STORED для JPEG/WebP/HEIC, DEFLATED для остального."""
+    if PurePosixPath(str(arcname)).suffix.lower() in STORED_EXTS:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+def _copy_member_data(src_zip, info, dst):
+    """Копирует сжатые данные члена архива (после его локального заголовка) в dst блоками."""
+    with src_zip._lock:
+        fp = src_zip.fp
+        fp.seek(info.header_offset)
+        header = struct.unpack(zipfile.structFileHeader, fp.read(zipfile.sizeFileHeader))
+        if header[zipfile._FH_SIGNATURE] != zipfile.stringFileHeader:
+            raise zipfile.BadZipFile(f"Повреждён локальный заголовок {info.filename}")
+        fp.seek(header[zipfile._FH_FILENAME_LENGTH] + header[zipfile._FH_EXTRA_FIELD_LENGTH], os.SEEK_CUR)
+        remaining = info.compress_size
+        while remaining > 0:
+            chunk = fp.read(min(COPY_CHUNK, remaining))
+            if not chunk:
+                raise zipfile.BadZipFile(f"Неожиданный конец данных {info.filename}")
+            dst.write(chunk)
+            remaining -= len(chunk)
+
+
+_METHOD_NAMES = {zipfile.ZIP_STORED: "stored", zipfile.ZIP_DEFLATED: "deflated"}
+# Поля ZipInfo, из которых при продолжении архива заново собирается центральный каталог
+_ENTRY_FIELDS = ("filename", "date_time", "compress_type", "CRC", "compress_size", "file_size", "header_offset",
+                 "external_attr", "flag_bits", "create_system", "create_version", "extract_version")
+
+
+def _entry_to_dict(zinfo, kind):
+    entry = {field: getattr(zinfo, field) for field in _ENTRY_FIELDS}
+    entry["extra"] = zinfo.extra.hex()
+    entry["kind"] = kind
+    return entry
+
+
+def _entry_from_dict(entry):
+    zinfo = zipfile.ZipInfo(entry["filename"], tuple(entry["date_time"]))
+    for field in _ENTRY_FIELDS[2:]:
+        setattr(zinfo, field, entry[field])
+    zinfo.extra = bytes.fromhex(entry["extra"])
+    return zinfo
+
+
+class ResultArchive:
+    """
+    ZIP-архив результата, который пишется прямо в файл на диске по одной записи
+    по мере готовности изображений. Содержимое архива целиком в память не читается.
+    Метод сжатия выбирается для каждой записи (compression_for), байты и время записи
+    учитываются отдельно по методам — см. compression_stats().
+    :param deflate_level: Уровень DEFLATE для сжимаемых записей
+    :param resume: (конец данных, записи) из контрольной точки пакета — продолжить архив,
+                   прерванный после checkpoint_state(), вместо создания нового
+    """
+
+    def __init__(self, path, deflate_level=DEFLATE_LEVEL, resume=None):
+        self.path = path
+        self.deflate_level = deflate_level
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.count = 0
+        # Метод -> [записей, байт на входе, байт в архиве, секунд]
+        self._written = {}
+        # Метод каждой записи по порядку и число записей на последней отметке checkpoint_state()
+        self._kinds = []
+        self._marked = 0
+        self._fp = None
+        if resume is None:
+            self._zip = zipfile.ZipFile(path, "w")
+        else:
+            self._zip = self._reopen(*resume)
+
+    def _reopen(self, end, entries):
+        """
+        Открывает недописанный архив: данные после end (записи, не попавшие в отметку) отбрасываются,
+        новые записи пишутся с этого места, а центральный каталог собирается из сохранённых записей.
+        """
+        self._fp = open(self.path, "r+b")
+        self._fp.truncate(end)
+        self._fp.seek(end)
+        # Режим "w" на переданном файле начинает запись с текущей позиции, смещения остаются абсолютными
+        zf = zipfile.ZipFile(self._fp, "w")
+        for entry in entries:
+            zinfo = _entry_from_dict(entry)
+            zf.filelist.append(zinfo)
+            zf.NameToInfo[zinfo.filename] = zinfo
+            self._account(entry["kind"], zinfo, time.perf_counter())
+        self._marked = len(zf.filelist)
+        return zf
+
+    def _new_info(self, arcname):
+        zinfo = zipfile.ZipInfo(str(arcname), time.localtime(time.time())[:6])
+        zinfo.compress_type = compression_for(arcname)
+        # Уровень записывается в ZipInfo: ZipFile.open(..., "w") берёт его оттуда
+        zinfo._compresslevel = self.deflate_level
+        zinfo.external_attr = 0o600 << 16
+        return zinfo
+
+    def _account(self, kind, zinfo, start):
+        totals = self._written.setdefault(kind, [0, 0, 0, 0.0])
+        totals[0] += 1
+        totals[1] += zinfo.file_size
+        totals[2] += zinfo.compress_size
+        totals[3] += time.perf_counter() - start
+        self._kinds.append(kind)
+        self.count += 1
+
+    def add_file(self, src, arcname, remove=False):
+        """
+        Добавляет файл в архив.
+        :param remove: Удалить исходный файл сразу после записи (промежуточные результаты)
+        """
+        start = time.perf_counter()
+        compress_type = compression_for(arcname)
+        self._zip.write(src, arcname=str(arcname), compress_type=compress_type, compresslevel=self.deflate_level)
+        self._account(_METHOD_NAMES[compress_type], self._zip.filelist[-1], start)
+        if remove:
+            os.remove(src)
+
+    def add_stream(self, fp, arcname):
+        """Копирует бинарный поток в новую запись архива блоками, не загружая его целиком в память."""
+        start = time.perf_counter()
+        zinfo = self._new_info(arcname)
+        with self._zip.open(zinfo, "w") as dst:
+            shutil.copyfileobj(fp, dst)
+        self._account(_METHOD_NAMES[zinfo.compress_type], zinfo, start)
+
+    def add_bytes(self, data, arcname):
+        start = time.perf_counter()
+        zinfo = self._new_info(arcname)
+        self._zip.writestr(zinfo, data)
+        self._account(_METHOD_NAMES[zinfo.compress_type], zinfo, start)
+
+    def copy_raw(self, src_zip, info, arcname):
+        """
+        Переносит член другого ZIP-архива под новым именем, копируя сжатые байты как есть:
+        без распаковки и повторного сжатия. Зашифрованные члены и неизвестные методы
+        сжатия копируются обычным способом через add_stream.
+        :param src_zip: Открытый на чтение ZipFile
+        :param info: ZipInfo члена src_zip
+        """
+        if info.flag_bits & 0x1 or info.compress_type not in RAW_COPY_METHODS:
+            with src_zip.open(info) as fp:
+                self.add_stream(fp, arcname)
+            return
+        zinfo = zipfile.ZipInfo(str(arcname), info.date_time)
+        zinfo.compress_type = info.compress_type
+        zinfo.create_system = info.create_system
+        zinfo.external_attr = info.external_attr
+        # Флаги data descriptor и UTF-8 имени выставляются заново при записи заголовка
+        zinfo.flag_bits = info.flag_bits & ~0x808
+        zinfo.CRC = info.CRC
+        zinfo.compress_size = info.compress_size
+        zinfo.file_size = info.file_size
+        start = time.perf_counter()
+        zf = self._zip
+        with zf._lock:
+            if zf._writing:
+                raise ValueError("Нельзя копировать член архива, пока открыта другая запись")
+            zf._writecheck(zinfo)
+            zf._didModify = True
+            if zf._seekable:
+                zf.fp.seek(zf.start_dir)
+            zinfo.header_offset = zf.fp.tell()
+            zf.fp.write(zinfo.FileHeader())
+            _copy_member_data(src_zip, info, zf.fp)
+            zf.start_dir = zf.fp.tell()
+            zf.filelist.append(zinfo)
+            zf.NameToInfo[zinfo.filename] = zinfo
+        self._account("copied", zinfo, start)
+
+    def compression_stats(self):
+        """
+        Сводка по методам записи: stored (без сжатия), deflated, copied (сжатые байты
+        перенесены из исходного архива). Для stored дана оценка времени, которое ушло бы
+        на DEFLATE при скорости, измеренной на сжатых записях этого же архива.
+        :return: {"deflate_level", метод: {"entries", "bytes_in", "bytes_out", "time"}, "saved_time"}
+        """
+        stats = {"deflate_level": self.deflate_level}
+        for kind, (entries, bytes_in, bytes_out, seconds) in self._written.items():
+            stats[kind] = {"entries": entries, "bytes_in": bytes_in, "bytes_out": bytes_out, "time": round(seconds, 4)}
+        stored = stats.get("stored")
+        deflated = stats.get("deflated")
+        stats["saved_time"] = None
+        if stored and deflated and deflated["time"] > 0 and deflated["bytes_in"]:
+            rate = deflated["bytes_in"] / deflated["time"]
+            stats["saved_time"] = round(max(0.0, stored["bytes_in"] / rate - stored["time"]), 3)
+        return stats
+
+    def checkpoint_state(self):
+        """
+        Отметка для контрольной точки пакета: данные сбрасываются на диск, и возвращаются конец
+        записанных данных и записи, добавленные с прошлой отметки. По отметкам архив можно
+        продолжить после аварийного завершения (resume).
+        :return: {"end": смещение, "entries": [dict записи]}
+        """
+        zf = self._zip
+        zf.fp.flush()
+        entries = [_entry_to_dict(zinfo, kind)
+                   for zinfo, kind in zip(zf.filelist[self._marked:], self._kinds[self._marked:])]
+        self._marked = len(zf.filelist)
+        return {"end": zf.start_dir, "entries": entries}
+
+    def close(self):
+        if self._zip is not None:
+            self._zip.close()
+            self._zip = None
+        if self._fp is not None:
+            self._fp.close()
+            self._fp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class ResultDirectory:
+    """Результат в обычной папке (для CLI) — тот же интерфейс, что у ResultArchive."""
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.count = 0
+
+    def _target(self, arcname):
+        """Путь файла в папке результата; имя, ведущее за пределы папки, — ошибка."""
+        root = os.path.realpath(self.path)
+        target = os.path.realpath(os.path.join(root, *PurePosixPath(str(arcname)).parts))
+        if os.path.commonpath([root, target]) != root or target == root:
+            raise ValueError(f"Имя {arcname} выходит за пределы папки результата")
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        return target
+
+    def add_file(self, src, arcname, remove=False):
+        if remove:
+            shutil.move(src, self._target(arcname))
+        else:
+            shutil.copyfile(src, self._target(arcname))
+        self.count += 1
+
+    def add_stream(self, fp, arcname):
+        with open(self._target(arcname), "wb") as dst:
+            shutil.copyfileobj(fp, dst)
+        self.count += 1
+
+    def add_bytes(self, data, arcname):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        with open(self._target(arcname), "wb") as dst:
+            dst.write(data)
+        self.count += 1
+
+    def copy_raw(self, src_zip, info, arcname):
+        """Член ZIP-архива распаковывается потоком прямо в файл папки результата."""
+        with src_zip.open(info) as fp:
+            self.add_stream(fp, arcname)
+
+    def compression_stats(self):
+        """В папку файлы пишутся без сжатия — сводки нет."""
+        return None
+
+    def checkpoint_state(self):
+        """Готовые файлы уже лежат в папке — для продолжения пакета отмечать нечего."""
+        return None
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def open_result(path, deflate_level=DEFLATE_LEVEL, checkpoint=None):
+    """
+    Результат в ZIP-архив (путь оканчивается на .zip) или в папку.
+    :param checkpoint: checkpoint.Checkpoint — продолжить архив прерванного пакета
+    """
+    if path.lower().endswith(".zip"):
+        return ResultArchive(path, deflate_level, resume=checkpoint.archive_state(path) if checkpoint else None)
+    return ResultDirectory(path)
@@ -0,0 +1,114 @@
+# batch.py
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from utils import MAX_WORKERS
+
+# Сколько заданий на процесс держать в работе одновременно: один выполняется, один ждёт в очереди
+IN_FLIGHT_PER_WORKER = 2
+
+
+def _run_job(func, job):
+    """
+    Выполняется в процессе-воркере: вызывает func(*job) и перехватывает ошибку,
+    чтобы в основной процесс вернулась строка, а не (возможно непиклируемое) исключение.
+    :return: (результат, текст ошибки или None, время выполнения в секундах)
+    """
+    start = time.perf_counter()
+    try:
+        return func(*job), None, time.perf_counter() - start
+    except Exception as e:
+        return None, str(e), time.perf_counter() - start
+
+
+def run_batch(func, jobs, workers=None, on_progress=None, on_result=None, total=None, max_in_flight=None):
+    """
+    Выполняет func(*job) для каждого задания в пуле процессов.
+    Задания должны содержать только пути и простые параметры (не PIL-изображения),
+    чтобы в воркеры не передавались большие объекты.
+    Задания берутся из jobs лениво: в работе (отправлены в пул или готовы, но ждут своей
+    очереди в on_result) одновременно не больше max_in_flight, поэтому число промежуточных
+    файлов и результатов в памяти не растёт с размером пакета.
+    :param func: Функция уровня модуля (должна пиклироваться)
+    :param jobs: Итерируемое с кортежами аргументов (список или генератор)
+    :param workers: Число процессов (по умолчанию MAX_WORKERS; 1 — без пула, в текущем процессе)
+    :param on_progress: callback(done, total) после завершения каждого задания
+    :param on_result: callback(index, job, result, error, elapsed) — вызывается строго в порядке заданий
+    :param total: Число заданий, если jobs — генератор
+    :param max_in_flight: Размер окна (по умолчанию workers * IN_FLIGHT_PER_WORKER)
+    :return: Число выполненных заданий
+    """
+    if total is None:
+        total = len(jobs)
+    jobs = iter(jobs)
+    workers = max(1, min(workers or MAX_WORKERS, total or 1))
+    done = 0
+
+    if workers == 1:
+        for i, job in enumerate(jobs):
+            result = _run_job(func, job)
+            done += 1
+            if on_result:
+                on_result(i, job, *result)
+            if on_progress:
+                on_progress(done, total)
+        return done
+
+    window = max_in_flight or workers * IN_FLIGHT_PER_WORKER
+    pending = {}
+    ready = {}
+    next_submit = 0
+    next_index = 0
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+
+        def _finish(i, job, result):
+            nonlocal done
+            ready[i] = (job, result)
+            done += 1
+            if on_progress:
+                on_progress(done, total)
+
+        def _fill():
+            # Новые задания отправляются, только пока окно от первого неотданного результата не заполнено
+            nonlocal next_submit
+            while next_submit < next_index + window:
+                job = next(jobs, None)
+                if job is None:
+                    return
+                try:
+                    pending[pool.submit(_run_job, func, job)] = (next_submit, job)
+                except BrokenProcessPool as e:
+                    # Пул сломан (воркер упал): это и все ещё не отправленные задания — ошибки файлов
+                    _finish(next_submit, job, (None, str(e), 0.0))
+                    for next_submit, job in enumerate(jobs, next_submit + 1):
+                        _finish(next_submit, job, (None, str(e), 0.0))
+                    next_submit += 1
+                    return
+                next_submit += 1
+
+        def _deliver():
+            # Отдаём готовые результаты по порядку, не дожидаясь конца пакета
+            nonlocal next_index
+            while next_index in ready:
+                job, result = ready.pop(next_index)
+                if on_result:
+                    on_result(next_index, job, *result)
+                next_index += 1
+
+        _fill()
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                i, job = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # Воркер упал целиком (например, BrokenProcessPool)
+                    result = (None, str(e), 0.0)
+                _finish(i, job, result)
+            _deliver()
+            _fill()
+        _deliver()
+    return done
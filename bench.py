@@ -0,0 +1,377 @@
+# bench.py
+# Бенчмарк режимов на синтетических наборах изображений.
+#
+#   python bench.py run --counts 10 100 --modes convert watermark --save main
+#   python bench.py run --counts 10 100 --compare main
+#   python bench.py startup            # время холодного старта и перезапуска страницы Recon2.py
+#
+# Каждый размер набора меряется дважды: на смеси JPEG/PNG/WebP/TIFF (…/mixed) и на HEIC (…/heic).
+#
+# Наборы генерируются детерминированно и кэшируются в --corpus-dir, каждый замер
+# выполняется в отдельном процессе, чтобы пиковый RSS не смешивался между замерами.
+import os
+import sys
+import json
+import time
+import random
+import zipfile
+import argparse
+import resource
+import tempfile
+import subprocess
+from io import BytesIO
+from PIL import Image, ImageDraw
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baselines")
+DEFAULT_CORPUS_DIR = os.path.join(tempfile.gettempdir(), "photoflow-bench")
+DEFAULT_WATERMARK = os.path.join(os.path.dirname(os.path.abspath(__file__)), "watermarks", "1.png")
+
+FORMATS = {
+    "jpeg": (".jpg", "JPEG", {"quality": 90}),
+    "png": (".png", "PNG", {}),
+    "webp": (".webp", "WEBP", {"quality": 85}),
+    "tiff": (".tiff", "TIFF", {}),
+    "heic": (".heic", "HEIF", {"quality": 80}),
+}
+DEFAULT_FORMATS = ("jpeg", "png", "webp", "tiff", "heic")
+DEFAULT_SIZES = ("640x480", "1920x1080", "4032x3024")
+LAYOUTS = ("flat", "nested")
+APP_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Recon2.py")
+# Бюджет страницы (мс): первый прогон скрипта в свежем процессе и повторный прогон (перезапуск)
+STARTUP_BUDGET_MS = 400
+RERUN_BUDGET_MS = 60
+# Модули, которые не должны загружаться при открытии страницы: нужны только при обработке или загрузке
+HEAVY_MODULES = ("PIL", "pillow_heif", "requests", "numpy", "googleapiclient")
+# Замер в отдельном интерпретаторе, без модулей самого bench.py (он импортирует PIL)
+_STARTUP_PROBE = """
+import sys, json, time
+start = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+imported = time.perf_counter()
+before = set(sys.modules)
+app = AppTest.from_file(sys.argv[1], default_timeout=120)
+t0 = time.perf_counter()
+app.run()
+t1 = time.perf_counter()
+app.run()
+t2 = time.perf_counter()
+print(json.dumps({
+    "streamlit_ms": (imported - start) * 1000, "first_run_ms": (t1 - t0) * 1000, "rerun_ms": (t2 - t1) * 1000,
+    "modules": sorted({name.split(".")[0] for name in set(sys.modules) - before}),
+}))
+"""
+# HEIC декодируется отдельным путём (libheif), его скорость меряется на отдельном наборе
+HEIF_FORMATS = ("heic",)
+
+
+def _parse_size(text):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def _available_formats(formats):
+    """HEIC пропускается, если pillow-heif не установлен."""
+    if "heic" in formats:
+        try:
+            import pillow_heif
+            pillow_heif.register_heif_opener()
+        except ImportError:
+            formats = tuple(f for f in formats if f != "heic")
+    return formats
+
+
+def _format_groups(formats):
+    """Разбивает форматы на группы замеров: "mixed" (все, кроме HEIC) и "heic"."""
+    groups = [
+        ("mixed", tuple(f for f in formats if f not in HEIF_FORMATS)),
+        ("heic", tuple(f for f in formats if f in HEIF_FORMATS)),
+    ]
+    return [(name, group) for name, group in groups if group]
+
+
+def _synthetic_image(index, size, seed):
+    """Детерминированное изображение: градиент и прямоугольники, уникальные для каждого индекса."""
+    rng = random.Random(seed * 1000003 + index)
+    gradient = Image.linear_gradient("L").resize(size)
+    img = Image.merge("RGB", (
+        gradient,
+        gradient.rotate(90).resize(size),
+        Image.new("L", size, rng.randrange(256)),
+    ))
+    draw = ImageDraw.Draw(img)
+    for _ in range(12):
+        x0, y0 = rng.randrange(size[0]), rng.randrange(size[1])
+        x1, y1 = x0 + rng.randrange(1, size[0] // 3 + 2), y0 + rng.randrange(1, size[1] // 3 + 2)
+        draw.rectangle((x0, y0, x1, y1), fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    draw.text((10, 10), f"#{index}", fill=(255, 255, 255))
+    return img
+
+
+def _member_name(index, ext, layout):
+    if layout == "nested":
+        return f"set_{index % 10:02d}/day_{index % 3}/img_{index:05d}{ext}"
+    return f"img_{index:05d}{ext}"
+
+
+def build_corpus(count, layout, formats, sizes, corpus_dir, seed=0):
+    """
+    Создаёт (или берёт из кэша) ZIP-архив с count изображениями. Форматы и разрешения
+    чередуются по индексу файла, поэтому набор одинаков при каждом запуске.
+    :return: Путь к архиву
+    """
+    key = f"{layout}-{count}-{'_'.join(formats)}-{'_'.join(sizes)}-s{seed}"
+    path = os.path.join(corpus_dir, f"corpus-{key}.zip")
+    if os.path.exists(path):
+        return path
+    os.makedirs(corpus_dir, exist_ok=True)
+    tmp_path = path + ".part"
+    parsed_sizes = [_parse_size(s) for s in sizes]
+    with zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_STORED) as zf:
+        for index in range(count):
+            ext, pil_format, options = FORMATS[formats[index % len(formats)]]
+            size = parsed_sizes[index % len(parsed_sizes)]
+            # TIFF требует seek при записи, поэтому файл сначала кодируется в память
+            buf = BytesIO()
+            _synthetic_image(index, size, seed).save(buf, pil_format, **options)
+            zf.writestr(_member_name(index, ext, layout), buf.getvalue())
+    os.replace(tmp_path, path)
+    return path
+
+
+def _peak_rss_mb():
+    """Пиковый RSS процесса и самого крупного из его дочерних процессов (МБ)."""
+    # ru_maxrss в килобайтах на Linux и в байтах на macOS
+    per_mb = 1024 * 1024 if sys.platform == "darwin" else 1024
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return round(max(own, children) / per_mb, 1)
+
+
+def run_case(mode, corpus, jobs, watermark, profile):
+    """Выполняет один режим без интерфейса над архивом corpus (в текущем процессе)."""
+    from archive import ResultArchive
+    from ingest import collect_paths, close_archives
+    from metrics import BatchMetrics
+    from core import run_rename, run_convert, run_watermark, run_combined
+
+    log = []
+    metrics = BatchMetrics(mode)
+    with tempfile.TemporaryDirectory() as tmp:
+        out = os.path.join(tmp, "result.zip")
+        start = time.perf_counter()
+        with metrics.stage("ingest"):
+            sources = collect_paths([corpus], log)
+        with ResultArchive(out) as result:
+            if mode == "rename":
+                stats = run_rename(sources, result, log, metrics=metrics)
+            elif mode == "convert":
+                stats = run_convert(sources, result, log, workers=jobs, work_dir=tmp, profile=profile, metrics=metrics)
+            elif mode == "watermark":
+                stats = run_watermark(sources, result, log, watermark, workers=jobs, work_dir=tmp,
+                                      profile=profile, metrics=metrics)
+            else:
+                # Все выходы за один проход: исходники, JPG, JPG со знаком и миниатюры
+                stats = run_combined(sources, result, log, workers=jobs, work_dir=tmp, profile=profile,
+                                     metrics=metrics, watermark={"watermark_path": watermark})
+        wall = time.perf_counter() - start
+        close_archives()
+        archive_size = os.path.getsize(out)
+    return {
+        "images": len(sources),
+        "errors": stats.get("errors", 0),
+        "wall_time": round(wall, 3),
+        "images_per_sec": round(len(sources) / wall, 2) if wall > 0 else 0.0,
+        "peak_rss_mb": _peak_rss_mb(),
+        "archive_mb": round(archive_size / 1024 / 1024, 2),
+        "compression": stats.get("archive"),
+        "stages": metrics.summary()["stages"],
+    }
+
+
+def _run_case_subprocess(mode, corpus, jobs, watermark, profile):
+    args = [sys.executable, os.path.abspath(__file__), "_case", mode, corpus,
+            "--jobs", str(jobs), "--watermark", watermark, "--profile", profile]
+    proc = subprocess.run(args, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if proc.returncode != 0:
+        raise RuntimeError(f"{mode} на {corpus} завершился с ошибкой:\n{proc.stderr}")
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def _build_corpus_subprocess(count, layout, formats, sizes, corpus_dir, seed):
+    """
+    Генерация набора тоже идёт в отдельном процессе: ru_maxrss наследуется дочерними
+    процессами, и память генератора иначе попала бы в пиковый RSS замеров.
+    """
+    args = [sys.executable, os.path.abspath(__file__), "_corpus", str(count), layout, corpus_dir,
+            "--formats", *formats, "--sizes", *sizes, "--seed", str(seed)]
+    proc = subprocess.run(args, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    if proc.returncode != 0:
+        raise RuntimeError(f"Не удалось создать набор {layout}/{count}:\n{proc.stderr}")
+    return proc.stdout.strip().splitlines()[-1]
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, baseline, threshold):
+    """
+    Сравнивает замеры с сохранённой базой. Регрессия — падение images/sec или рост
+    пикового RSS больше чем на threshold (доля).
+    :return: Список строк-отчётов о регрессиях
+    """
+    base = {r["case"]: r for r in baseline["results"]}
+    regressions = []
+    for r in results:
+        old = base.get(r["case"])
+        if not old:
+            continue
+        speed = r["images_per_sec"] / old["images_per_sec"] - 1 if old["images_per_sec"] else 0.0
+        rss = r["peak_rss_mb"] / old["peak_rss_mb"] - 1 if old["peak_rss_mb"] else 0.0
+        print(f"  {r['case']:<32} images/sec {speed:+.1%}  peak RSS {rss:+.1%}")
+        if speed < -threshold:
+            regressions.append(f"{r['case']}: images/sec {old['images_per_sec']} → {r['images_per_sec']}")
+        if rss > threshold:
+            regressions.append(f"{r['case']}: peak RSS {old['peak_rss_mb']} → {r['peak_rss_mb']} МБ")
+    return regressions
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def cmd_startup(args):
+    """
+    Время открытия страницы: импорт streamlit, первый прогон Recon2.py в свежем процессе
+    (холодный старт) и повторный прогон (перезапуск при любом действии пользователя).
+    Каждый замер — в новом интерпретаторе; берётся медиана из --repeat.
+    :return: 1, если превышен бюджет или при старте загружаются тяжёлые модули
+    """
+    samples = []
+    for _ in range(args.repeat):
+        out = subprocess.run([sys.executable, "-c", _STARTUP_PROBE, APP_SCRIPT], check=True,
+                             capture_output=True, text=True).stdout
+        samples.append(json.loads(out.strip().splitlines()[-1]))
+    first = _median([s["first_run_ms"] for s in samples])
+    rerun = _median([s["rerun_ms"] for s in samples])
+    heavy = sorted({m for s in samples for m in s["modules"] if m in HEAVY_MODULES})
+    print(f"Импорт streamlit: {_median([s['streamlit_ms'] for s in samples]):.0f} мс")
+    print(f"Первый прогон:    {first:.0f} мс (бюджет {args.budget_ms} мс)")
+    print(f"Перезапуск:       {rerun:.0f} мс (бюджет {args.rerun_budget_ms} мс)")
+    print(f"Тяжёлые модули при старте: {', '.join(heavy) or 'нет'}")
+    problems = []
+    if first > args.budget_ms:
+        problems.append(f"первый прогон {first:.0f} мс > {args.budget_ms} мс")
+    if rerun > args.rerun_budget_ms:
+        problems.append(f"перезапуск {rerun:.0f} мс > {args.rerun_budget_ms} мс")
+    if heavy:
+        problems.append(f"при старте загружаются {', '.join(heavy)}")
+    for line in problems:
+        print(f"  Превышение: {line}")
+    return 1 if problems else 0
+
+
+def cmd_run(args):
+    formats = _available_formats(tuple(args.formats))
+    results = []
+    for layout in args.layouts:
+        for count in args.counts:
+            for group, group_formats in _format_groups(formats):
+                corpus = _build_corpus_subprocess(count, layout, group_formats, args.sizes, args.corpus_dir, args.seed)
+                for mode in args.modes:
+                    case = f"{mode}/{layout}/{count}/{group}"
+                    r = _run_case_subprocess(mode, corpus, args.jobs, args.watermark, args.profile)
+                    r["case"] = case
+                    results.append(r)
+                    print(f"{case:<32} {r['images_per_sec']:>9.1f} img/s  {r['peak_rss_mb']:>8.1f} МБ RSS  "
+                          f"{r['archive_mb']:>8.1f} МБ zip  ({r['wall_time']:.2f} сек)")
+    report = {
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "revision": _git_revision(),
+        "jobs": args.jobs,
+        "profile": args.profile,
+        "formats": list(formats),
+        "sizes": list(args.sizes),
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.save:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(os.path.join(BASELINE_DIR, f"{args.save}.json"), "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(os.path.join(BASELINE_DIR, f"{args.compare}.json"), encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"Сравнение с {args.compare} (ревизия {baseline.get('revision')}):")
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("Регрессии:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+    return 0
+
+
+def main(argv=None):
+    from utils import MAX_WORKERS
+    from imaging import ENCODE_PROFILES, DEFAULT_PROFILE
+
+    parser = argparse.ArgumentParser(prog="python bench.py", description="Бенчмарк режимов PhotoFlow.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    run = sub.add_parser("run", help="Сгенерировать наборы и замерить режимы")
+    run.add_argument("--modes", nargs="+", choices=("rename", "convert", "watermark", "combined"),
+                     default=["rename", "convert", "watermark"])
+    run.add_argument("--counts", nargs="+", type=int, default=[10, 100, 1000])
+    run.add_argument("--layouts", nargs="+", choices=LAYOUTS, default=list(LAYOUTS))
+    run.add_argument("--formats", nargs="+", choices=tuple(FORMATS), default=list(DEFAULT_FORMATS))
+    run.add_argument("--sizes", nargs="+", default=list(DEFAULT_SIZES), help="Разрешения, например 1920x1080")
+    run.add_argument("--seed", type=int, default=0)
+    run.add_argument("--jobs", type=int, default=MAX_WORKERS)
+    run.add_argument("--profile", choices=tuple(ENCODE_PROFILES), default=DEFAULT_PROFILE)
+    run.add_argument("--watermark", default=DEFAULT_WATERMARK)
+    run.add_argument("--corpus-dir", default=DEFAULT_CORPUS_DIR)
+    run.add_argument("--output", help="Сохранить отчёт в JSON")
+    run.add_argument("--save", metavar="NAME", help=f"Сохранить как базу в {os.path.basename(BASELINE_DIR)}/NAME.json")
+    run.add_argument("--compare", metavar="NAME", help="Сравнить с сохранённой базой")
+    run.add_argument("--threshold", type=float, default=0.10, help="Допустимое ухудшение (доля), по умолчанию 0.10")
+    startup = sub.add_parser("startup", help="Замерить холодный старт и перезапуск страницы")
+    startup.add_argument("--repeat", type=int, default=3)
+    startup.add_argument("--budget-ms", type=int, default=STARTUP_BUDGET_MS)
+    startup.add_argument("--rerun-budget-ms", type=int, default=RERUN_BUDGET_MS)
+    case = sub.add_parser("_case", help=argparse.SUPPRESS)
+    case.add_argument("mode")
+    case.add_argument("corpus")
+    case.add_argument("--jobs", type=int, default=MAX_WORKERS)
+    case.add_argument("--watermark", default=DEFAULT_WATERMARK)
+    case.add_argument("--profile", default=DEFAULT_PROFILE)
+    corpus = sub.add_parser("_corpus", help=argparse.SUPPRESS)
+    corpus.add_argument("count", type=int)
+    corpus.add_argument("layout", choices=LAYOUTS)
+    corpus.add_argument("corpus_dir")
+    corpus.add_argument("--formats", nargs="+", default=list(DEFAULT_FORMATS))
+    corpus.add_argument("--sizes", nargs="+", default=list(DEFAULT_SIZES))
+    corpus.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.command == "_corpus":
+        formats = _available_formats(tuple(args.formats))
+        print(build_corpus(args.count, args.layout, formats, tuple(args.sizes), args.corpus_dir, args.seed))
+        return 0
+    if args.command == "_case":
+        _available_formats(("heic",))
+        print(json.dumps(run_case(args.mode, args.corpus, args.jobs, args.watermark, args.profile)))
+        return 0
+    if args.command == "startup":
+        return cmd_startup(args)
+    return cmd_run(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
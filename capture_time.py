@@ -0,0 +1,249 @@
+# capture_time.py
+# Время съёмки (EXIF DateTimeOriginal) для сортировки фото. Читаются только заголовки с
+# метаданными — сегменты APP1 в JPEG, блоки meta/iinf/iloc в HEIF, каталоги IFD в TIFF, —
+# пиксели не декодируются и PIL не нужен. Если EXIF нет — время изменения файла.
+import os
+import io
+import time
+import struct
+from datetime import datetime
+from utils import JPEG_EXTS, HEIF_EXTS, TIFF_EXTS
+from ingest import map_chunked
+
+# Потоков для чтения заголовков: работа упирается в ввод-вывод, а не в процессор
+CAPTURE_TIME_THREADS = 16
+
+_TAG_EXIF_IFD = 0x8769
+_TAG_DATETIME = 0x0132
+_TAG_DATETIME_ORIGINAL = 0x9003
+_TAG_DATETIME_DIGITIZED = 0x9004
+_TAG_SUBSEC_ORIGINAL = 0x9291
+_TYPE_ASCII = 2
+# Не больше стольких записей в одном IFD (защита от повреждённых файлов)
+_MAX_IFD_ENTRIES = 1024
+
+
+def _read_ifd(fp, base, offset, order):
+    """Записи каталога IFD: {тег: (тип, количество, 4 байта значения или смещения)}."""
+    fp.seek(base + offset)
+    raw = fp.read(2)
+    if len(raw) < 2:
+        return {}
+    count = min(struct.unpack(order + "H", raw)[0], _MAX_IFD_ENTRIES)
+    data = fp.read(count * 12)
+    entries = {}
+    for i in range(len(data) // 12):
+        tag, typ, n = struct.unpack(order + "HHI", data[i * 12:i * 12 + 8])
+        entries[tag] = (typ, n, data[i * 12 + 8:i * 12 + 12])
+    return entries
+
+
+def _ascii(fp, base, order, entry):
+    if entry is None or entry[0] != _TYPE_ASCII:
+        return None
+    _, n, value = entry
+    if n <= 4:
+        raw = value[:n]
+    else:
+        fp.seek(base + struct.unpack(order + "I", value)[0])
+        raw = fp.read(n)
+    return raw.split(b"\0", 1)[0].decode("ascii", "ignore").strip()
+
+
+def _parse_datetime(text, subsec=None):
+    try:
+        moment = datetime.strptime(text, "%Y:%m:%d %H:%M:%S")
+    except (TypeError, ValueError):
+        # Пусто, "0000:00:00 00:00:00" и прочие заглушки камер
+        return None
+    if subsec and subsec.isdigit():
+        moment = moment.replace(microsecond=int(subsec[:6].ljust(6, "0")))
+    return moment
+
+
+def _tiff_datetime(fp, base=0):
+    """
+    Время съёмки из структуры TIFF (сам TIFF-файл или блок EXIF внутри JPEG/HEIF), начиная с base:
+    DateTimeOriginal, затем DateTimeDigitized, затем DateTime из IFD0.
+    """
+    fp.seek(base)
+    head = fp.read(8)
+    order = {b"II": "<", b"MM": ">"}.get(head[:2])
+    if order is None or len(head) < 8:
+        return None
+    ifd0 = _read_ifd(fp, base, struct.unpack(order + "I", head[4:8])[0], order)
+    pointer = ifd0.get(_TAG_EXIF_IFD)
+    if pointer is not None:
+        exif = _read_ifd(fp, base, struct.unpack(order + "I", pointer[2])[0], order)
+        subsec = _ascii(fp, base, order, exif.get(_TAG_SUBSEC_ORIGINAL))
+        for tag in (_TAG_DATETIME_ORIGINAL, _TAG_DATETIME_DIGITIZED):
+            moment = _parse_datetime(_ascii(fp, base, order, exif.get(tag)), subsec)
+            if moment:
+                return moment
+    return _parse_datetime(_ascii(fp, base, order, ifd0.get(_TAG_DATETIME)))
+
+
+def _jpeg_datetime(fp):
+    """Ищет сегмент APP1 с EXIF среди маркеров до начала данных изображения (SOS)."""
+    if fp.read(2) != b"\xff\xd8":
+        return None
+    while True:
+        marker = fp.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        code = marker[1]
+        if code == 0xFF:
+            # Заполняющий байт перед маркером
+            fp.seek(-1, os.SEEK_CUR)
+            continue
+        if code == 0xDA or code == 0xD9:
+            return None
+        length = struct.unpack(">H", fp.read(2))[0]
+        if code == 0xE1:
+            segment = fp.read(length - 2)
+            if segment.startswith(b"Exif\0\0"):
+                return _tiff_datetime(io.BytesIO(segment), 6)
+            continue
+        fp.seek(length - 2, os.SEEK_CUR)
+
+
+def _boxes(fp, end):
+    """Блоки ISO BMFF от текущей позиции до end: (тип, начало содержимого, конец блока)."""
+    while fp.tell() + 8 <= end:
+        start = fp.tell()
+        size, kind = struct.unpack(">I4s", fp.read(8))
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", fp.read(8))[0]
+            header = 16
+        elif size == 0:
+            size = end - start
+        if size < header:
+            return
+        yield kind, start + header, start + size
+        fp.seek(start + size)
+
+
+def _heif_exif_item(fp, start, end):
+    """Разбирает блок meta: ID элемента типа Exif (iinf/infe) и его экстенты (iloc)."""
+    exif_id = None
+    locations = {}
+    fp.seek(start + 4)  # версия и флаги meta
+    for kind, body, box_end in _boxes(fp, end):
+        if kind == b"iinf":
+            version = fp.read(1)[0]
+            fp.read(3)
+            fp.read(2 if version == 0 else 4)
+            for entry, entry_body, _ in _boxes(fp, box_end):
+                if entry != b"infe":
+                    continue
+                version = fp.read(1)[0]
+                fp.read(3)
+                if version < 2:
+                    continue
+                item_id = struct.unpack(">H" if version == 2 else ">I", fp.read(2 if version == 2 else 4))[0]
+                fp.read(2)  # protection index
+                if fp.read(4) == b"Exif":
+                    exif_id = item_id
+        elif kind == b"iloc":
+            version = fp.read(1)[0]
+            fp.read(3)
+            sizes = struct.unpack(">H", fp.read(2))[0]
+            offset_size, length_size, base_size = sizes >> 12, (sizes >> 8) & 0xF, (sizes >> 4) & 0xF
+            index_size = sizes & 0xF if version in (1, 2) else 0
+            count = struct.unpack(">H" if version < 2 else ">I", fp.read(2 if version < 2 else 4))[0]
+
+            def number(size):
+                return int.from_bytes(fp.read(size), "big") if size else 0
+
+            for _ in range(count):
+                item_id = number(2 if version < 2 else 4)
+                method = number(2) & 0xF if version in (1, 2) else 0
+                fp.read(2)  # data reference index
+                base_offset = number(base_size)
+                extents = []
+                for _ in range(number(2)):
+                    number(index_size)
+                    extents.append((base_offset + number(offset_size), number(length_size)))
+                # Только данные в самом файле (construction_method 0)
+                if method == 0:
+                    locations[item_id] = extents
+    return locations.get(exif_id)
+
+
+def _heif_datetime(fp, end):
+    """
+    EXIF из HEIF/HEIC: элемент Exif в блоке meta; читаются только meta и сам блок EXIF.
+    Конец файла end берётся из размера источника: поиск конца сжатого члена ZIP распаковал бы его целиком.
+    """
+    for kind, body, box_end in _boxes(fp, end):
+        if kind == b"meta":
+            extents = _heif_exif_item(fp, body, box_end)
+            if not extents:
+                return None
+            parts = []
+            for offset, length in extents:
+                fp.seek(offset)
+                parts.append(fp.read(length))
+            data = b"".join(parts)
+            if len(data) < 4:
+                return None
+            # Первые 4 байта — смещение TIFF-заголовка от конца этого поля (обычно после "Exif\0\0")
+            skip = struct.unpack(">I", data[:4])[0]
+            return _tiff_datetime(io.BytesIO(data), 4 + skip)
+    return None
+
+
+def exif_datetime(src):
+    """
+    Время съёмки из EXIF изображения (ImageSource) или None. Разбираются только заголовки;
+    для форматов без своего разборщика (PNG, WebP, BMP) — None.
+    """
+    if src.suffix in JPEG_EXTS:
+        parse = _jpeg_datetime
+    elif src.suffix in HEIF_EXTS:
+        parse = lambda fp: _heif_datetime(fp, src.size)
+    elif src.suffix in TIFF_EXTS:
+        parse = _tiff_datetime
+    else:
+        return None
+    try:
+        with src.open(materialize=False) as fp:
+            return parse(fp)
+    except (OSError, ValueError, IndexError, struct.error):
+        return None
+
+
+def file_datetime(src):
+    """
+    Время изменения файла: для членов ZIP — из центрального каталога архива.
+    Недопустимое время (нулевая дата DOS у некоторых упаковщиков) — None, как и отсутствие времени.
+    """
+    try:
+        member = src.zip_member()
+        if member is not None:
+            return datetime(*member[1].date_time)
+        if src.path is not None:
+            return datetime.fromtimestamp(os.path.getmtime(src.path))
+    except (ValueError, OverflowError, OSError):
+        return None
+    return None
+
+
+def _capture_time(src):
+    """Выполняется в потоке пула: (время съёмки или изменения файла, из EXIF ли)."""
+    moment = exif_datetime(src)
+    return (moment, True) if moment else (file_datetime(src), False)
+
+
+def capture_times(sources, threads=CAPTURE_TIME_THREADS):
+    """
+    Время съёмки для списка ImageSource. Заголовки читаются в пуле потоков (ingest.map_chunked).
+    :return: (список (datetime или None, из EXIF ли), сколько взято из EXIF, секунд)
+    """
+    start = time.perf_counter()
+    if not sources:
+        return [], 0, 0.0
+    times = map_chunked(_capture_time, sources, threads, "photoflow-exif")
+    from_exif = sum(1 for _, exif in times if exif)
+    return times, from_exif, time.perf_counter() - start
@@ -0,0 +1,143 @@
+# checkpoint.py
+# Контрольные точки пакета. Манифест в рабочей папке отмечает, какие изображения уже обработаны
+# и записаны в результат, а для ZIP-результата — и какие записи архива к этому моменту на диске.
+# Промежуточные файлы удаляются сразу после записи, как и без контрольной точки. Пакет, прерванный
+# исключением или перезапуском процесса, при повторном запуске с той же папкой продолжает
+# недописанный архив (archive.ResultArchive, resume) и обрабатывает только оставшиеся изображения.
+import os
+import json
+import shutil
+import hashlib
+import contextlib
+
+MANIFEST_NAME = "manifest.jsonl"
+# Папка промежуточных файлов внутри рабочей папки (см. core._output_path)
+OUTPUT_DIR = "_out"
+
+
+def _source_fingerprint(src):
+    """
+    Имя, размер и признак содержимого исходника, доступный без чтения данных: CRC-32 из
+    центрального каталога для членов ZIP, время изменения для файлов на диске.
+    """
+    member = src.zip_member()
+    if member is not None:
+        return src.name, src.size, member[1].CRC
+    if src.path is not None:
+        try:
+            return src.name, src.size, os.stat(src.path).st_mtime_ns
+        except OSError:
+            return src.name, src.size, None
+    return src.name, src.size, None
+
+
+def batch_key(mode, params, sources):
+    """
+    Отпечаток пакета: режим, параметры и список исходников (_source_fingerprint). Манифест с другим
+    отпечатком относится к другому пакету и при возобновлении не используется.
+    """
+    raw = json.dumps([mode, params, [_source_fingerprint(src) for src in sources]], sort_keys=True, default=str)
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class Checkpoint:
+    """
+    Манифест пакета в рабочей папке: первая строка — отпечаток пакета, далее по строке на каждое
+    обработанное изображение: {"index": индекс исходника, "value": dict воркера, "error": текст ошибки,
+    "archive": ResultArchive.checkpoint_state() — записи, добавленные в архив вместе с изображением}.
+    Строки дописываются по одной, поэтому аварийное завершение теряет не больше последней строки.
+    Ошибки тоже отмечаются: записи изображения с ошибкой (например, исходник в "original") уже
+    в архиве, и повторная обработка дописала бы их второй раз.
+    :param work_dir: Рабочая папка пакета (та же, что передаётся в core.run_* как work_dir)
+    :param key: Отпечаток пакета (batch_key)
+    """
+
+    def __init__(self, work_dir, key):
+        self.work_dir = work_dir
+        self.key = key
+        self.path = os.path.join(work_dir, MANIFEST_NAME)
+        self._state = None
+
+    def _load(self):
+        """
+        Читает манифест один раз: ({индекс: (value, error)}, конец данных архива или None, записи архива).
+        Манифест другого пакета начинается заново.
+        """
+        if self._state is not None:
+            return self._state
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            lines = []
+        try:
+            header = json.loads(lines[0]) if lines else {}
+        except ValueError:
+            header = {}
+        if header.get("key") != self.key:
+            self.reset()
+            return self._state
+        done = {}
+        end = None
+        entries = []
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # Недописанная строка при аварийном завершении
+                break
+            value = entry["value"]
+            if value is not None:
+                # Замеры этапов относятся к прошлому запуску
+                value["stages"] = {}
+            done[entry["index"]] = value, entry.get("error")
+            if entry.get("archive"):
+                end = entry["archive"]["end"]
+                entries.extend(entry["archive"]["entries"])
+        self._state = done, end, entries
+        return self._state
+
+    def completed(self):
+        """Изображения, обработанные в прошлом запуске: {индекс: (value, текст ошибки или None)}."""
+        return self._load()[0]
+
+    def archive_state(self, path):
+        """
+        Состояние ZIP-результата на последней отметке — (конец данных, записи) для
+        ResultArchive(resume=...), или None, если архив начинается заново. Если архива нет
+        или он короче отметки, пакет тоже начинается заново.
+        """
+        done, end, entries = self._load()
+        if not done:
+            return None
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = -1
+        if end is None or size < end:
+            self.reset()
+            return None
+        return end, entries
+
+    def reset(self):
+        """Начинает манифест заново: прежние промежуточные файлы к этому пакету не относятся."""
+        shutil.rmtree(os.path.join(self.work_dir, OUTPUT_DIR), ignore_errors=True)
+        os.makedirs(self.work_dir, exist_ok=True)
+        with open(self.path, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"key": self.key}) + "\n")
+        self._state = {}, None, []
+
+    def mark(self, index, value, error=None, archive=None):
+        """
+        Отмечает изображение обработанным: всё, что с ним связано, уже записано в результат.
+        :param archive: ResultArchive.checkpoint_state() после записи изображения (None для папки)
+        """
+        entry = {"index": index, "value": value, "error": None if error is None else str(error), "archive": archive}
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def finish(self):
+        """Пакет завершён: манифест и промежуточные файлы больше не нужны."""
+        shutil.rmtree(os.path.join(self.work_dir, OUTPUT_DIR), ignore_errors=True)
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.path)
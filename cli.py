@@ -0,0 +1,139 @@
+# cli.py
+# Запуск обработки без интерфейса: python -m cli --mode convert фото.zip папка/ -o результат.zip
+import os
+import sys
+import json
+import time
+import argparse
+from PIL import ImageColor
+from utils import MAX_WORKERS
+from archive import open_result, DEFLATE_LEVEL
+from ingest import collect_paths, close_archives
+from core import MODES, COMBINED_OUTPUTS, RENAME_ORDERS, run_rename, run_convert, run_watermark, run_combined
+from core import format_encode_stats, format_archive_stats
+from imaging import ENCODE_PROFILES, DEFAULT_PROFILE, TILE_SPACING, TILE_ANGLE, DEFAULT_FONT, DEFAULT_TEXT_COLOR
+from metrics import BatchMetrics
+from result_cache import default_cache, file_digest
+from checkpoint import Checkpoint, batch_key
+
+POSITIONS = ("top_left", "top_right", "center", "bottom_left", "bottom_right", "tile")
+# Счётчики из статистики режимов, которые печатаются в итоговой строке
+COUNT_KEYS = ("total", "renamed", "skipped", "converted", "processed", "errors", "cache_hits", "decodes", "duplicates", "resumed")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m cli",
+        description="PhotoFlow: переименование, конвертация в JPG и водяные знаки без интерфейса.",
+    )
+    parser.add_argument("inputs", nargs="+", help="Файлы изображений, папки или ZIP-архивы")
+    parser.add_argument("-o", "--output", required=True, help="ZIP-архив (*.zip) или папка для результата")
+    parser.add_argument("--mode", choices=MODES, required=True, help="Режим обработки")
+    parser.add_argument("-j", "--jobs", type=int, default=MAX_WORKERS, help=f"Число процессов (по умолчанию {MAX_WORKERS})")
+    parser.add_argument("--profile", choices=tuple(ENCODE_PROFILES), default=DEFAULT_PROFILE, help="Профиль JPEG-кодирования")
+    parser.add_argument("--watermark", help="PNG/JPG водяного знака (для --mode watermark)")
+    parser.add_argument("--text", help="Текст водяного знака вместо картинки --watermark")
+    parser.add_argument("--font", help=f"TTF/OTF-шрифт для --text (по умолчанию {DEFAULT_FONT})")
+    parser.add_argument("--text-color", type=ImageColor.getrgb, default=DEFAULT_TEXT_COLOR, metavar="ЦВЕТ",
+                        help="Цвет текста: #RRGGBB или имя цвета (по умолчанию белый)")
+    parser.add_argument("--position", choices=POSITIONS, default="bottom_right", help="Положение водяного знака")
+    parser.add_argument("--opacity", type=float, default=0.6, help="Прозрачность водяного знака, 0.0-1.0")
+    parser.add_argument("--scale", type=float, default=0.25, help="Ширина водяного знака относительно фото, 0.0-1.0")
+    parser.add_argument("--tile-spacing", type=float, default=TILE_SPACING,
+                        help="Промежуток между знаками для --position tile, доля размера знака")
+    parser.add_argument("--tile-angle", type=float, default=TILE_ANGLE, help="Угол наклона знаков для --position tile, градусы")
+    parser.add_argument("--outputs", nargs="+", choices=tuple(COMBINED_OUTPUTS), default=list(COMBINED_OUTPUTS),
+                        help="Выходы для --mode combined (каждый — в своей папке результата)")
+    parser.add_argument("--order", choices=RENAME_ORDERS, default="name",
+                        help="Порядок нумерации: name — по имени файла, date — по времени съёмки из EXIF")
+    parser.add_argument("--no-rename", action="store_true", help="Не переименовывать файлы в --mode combined")
+    parser.add_argument("--zip-level", type=int, choices=range(0, 10), default=DEFLATE_LEVEL, metavar="0-9",
+                        help=f"Уровень DEFLATE для PNG/TIFF/BMP и текста в ZIP (по умолчанию {DEFLATE_LEVEL})")
+    parser.add_argument("--no-cache", action="store_true", help="Не использовать кэш готовых результатов")
+    parser.add_argument("--no-dedup", action="store_true",
+                        help="Обрабатывать одинаковые по содержимому файлы каждый отдельно")
+    parser.add_argument("--work-dir", help="Рабочая папка с контрольными точками: повторный запуск той же "
+                                           "команды с этой папкой продолжит прерванный пакет")
+    parser.add_argument("--log", help="Сохранить лог обработки в файл")
+    parser.add_argument("--stats", help="Сохранить статистику и замеры этапов в JSON")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Не выводить прогресс")
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    needs_watermark = args.mode == "watermark" or (args.mode == "combined" and "watermark" in args.outputs)
+    if needs_watermark and not (args.watermark or args.text):
+        print("Для водяного знака нужен --watermark или --text", file=sys.stderr)
+        return 2
+
+    def on_progress(done, total):
+        if not args.quiet:
+            print(f"\r{done}/{total}", end="", file=sys.stderr, flush=True)
+
+    cache = None if args.no_cache else default_cache()
+    watermark = {
+        "watermark_path": os.path.abspath(args.watermark) if args.watermark else None,
+        "position": args.position, "opacity": args.opacity, "scale": args.scale,
+        "tile_spacing": args.tile_spacing, "tile_angle": args.tile_angle, "text": args.text,
+        "text_options": {"font_path": args.font and os.path.abspath(args.font), "color": args.text_color[:3]},
+    }
+    log = []
+    start = time.perf_counter()
+    metrics = BatchMetrics(args.mode)
+    with metrics.stage("ingest"):
+        sources = collect_paths(args.inputs, log)
+    if not sources:
+        print("Не найдено ни одного поддерживаемого изображения.", file=sys.stderr)
+        return 1
+    checkpoint = None
+    if args.work_dir and args.mode != "rename":
+        # Готовые изображения прошлого запуска берутся, только если пакет и параметры те же
+        key_params = {"output": os.path.abspath(args.output), "profile": args.profile, "outputs": args.outputs, "rename": not args.no_rename,
+                      "order": args.order, "dedup": not args.no_dedup, "watermark": watermark,
+                      "watermark_digest": file_digest(args.watermark) if args.watermark else None}
+        checkpoint = Checkpoint(args.work_dir, batch_key(args.mode, key_params, sources))
+    try:
+        with open_result(args.output, args.zip_level, checkpoint) as result:
+            if args.mode == "rename":
+                stats = run_rename(sources, result, log, on_progress=on_progress, metrics=metrics, order=args.order)
+            elif args.mode == "convert":
+                stats = run_convert(sources, result, log, workers=args.jobs, on_progress=on_progress, profile=args.profile, metrics=metrics, cache=cache,
+                                    dedup=not args.no_dedup, work_dir=args.work_dir, checkpoint=checkpoint)
+            elif args.mode == "watermark":
+                stats = run_watermark(
+                    sources, result, log, watermark["watermark_path"], workers=args.jobs, on_progress=on_progress,
+                    profile=args.profile, metrics=metrics, cache=cache, dedup=not args.no_dedup,
+                    work_dir=args.work_dir, checkpoint=checkpoint,
+                    **{k: v for k, v in watermark.items() if k != "watermark_path"},
+                )
+            else:
+                stats = run_combined(
+                    sources, result, log, outputs=args.outputs, rename=not args.no_rename, workers=args.jobs,
+                    on_progress=on_progress, profile=args.profile, metrics=metrics,
+                    watermark=watermark if "watermark" in args.outputs else None, order=args.order,
+                    dedup=not args.no_dedup, work_dir=args.work_dir, checkpoint=checkpoint,
+                )
+    finally:
+        close_archives()
+    elapsed = time.perf_counter() - start
+    if not args.quiet:
+        print(file=sys.stderr)
+    stats["perf"] = metrics.summary()
+    if args.stats:
+        with open(args.stats, "w", encoding="utf-8") as f:
+            json.dump(stats, f, ensure_ascii=False, indent=2)
+    if args.log:
+        with open(args.log, "w", encoding="utf-8") as f:
+            f.write("\n".join(log))
+    summary = ", ".join(f"{k}: {v}" for k, v in stats.items() if k in COUNT_KEYS)
+    print(f"{summary}; {elapsed:.2f} сек, {len(sources) / elapsed:.1f} изобр./сек")
+    if "profile" in stats:
+        print(format_encode_stats(stats))
+    if stats.get("archive"):
+        print(format_archive_stats(stats["archive"]))
+    return 0 if not stats.get("errors") else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
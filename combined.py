@@ -0,0 +1,40 @@
+# combined.py
+import streamlit as st
+from utils import filter_large_files, MAX_WORKERS
+from imaging import DEFAULT_PROFILE
+from jobs import start_job
+
+
+def process_combined_mode(uploaded_files, outputs, rename=True, watermark=None, workers=MAX_WORKERS,
+                          profile=DEFAULT_PROFILE, order="name"):
+    """
+    Кнопка комбинированного режима: все выбранные выходы за один проход по фото.
+    :param outputs: Выходы из core.COMBINED_OUTPUTS
+    :param watermark: Параметры водяного знака для выхода "watermark" (см. imaging.apply_watermark)
+    """
+    uploaded_files = filter_large_files(uploaded_files)
+    if not uploaded_files or not outputs:
+        return
+    if "watermark" in outputs and not (watermark and (watermark.get("watermark_path") or watermark.get("text"))):
+        st.info("Для водяного знака выберите картинку или введите текст.")
+        return
+    if st.button("Обработать и скачать архив", key="process_combined_btn"):
+        if "watermark" in outputs:
+            watermark = dict(watermark)
+            if watermark.get("watermark_path"):
+                # Текст используется, только если не выбрана картинка
+                watermark["text"] = None
+        else:
+            watermark = None
+        params = {"outputs": list(outputs), "rename": rename, "profile": profile, "watermark": watermark,
+                  "order": order}
+        # Каждое фото декодируется один раз, все выходы дописываются в один архив по папкам
+        job_id, log, _ = start_job(st.session_state["session_id"], "combined", uploaded_files, params,
+                                   workers=workers)
+        if job_id is None:
+            st.error("Не найдено ни одного поддерживаемого изображения.")
+            st.session_state["result_zip"] = None
+            st.session_state["stats"] = {"total": 0, "processed": 0, "errors": 0}
+            st.session_state["log"] = log
+            return
+        st.session_state["job_id"] = job_id
@@ -0,0 +1,497 @@
+# core.py
+# Пакетная обработка без интерфейса: одни и те же функции вызывают Streamlit-режимы и CLI.
+import os
+import time
+import tempfile
+import contextlib
+from datetime import datetime
+from pathlib import PurePosixPath
+from utils import MAX_WORKERS
+from batch import run_batch
+from imaging import convert_file, watermark_file, multi_output_file, DEFAULT_PROFILE, TILE_SPACING, TILE_ANGLE
+from result_cache import cached_call, file_digest
+from capture_time import capture_times
+from dedup import find_duplicates
+from checkpoint import OUTPUT_DIR
+
+MODES = ("rename", "convert", "watermark", "combined")
+# Порядок нумерации при переименовании: по имени файла или по времени съёмки (EXIF, иначе время файла)
+RENAME_ORDERS = ("name", "date")
+# Выходы комбинированного режима и их папки в результате
+COMBINED_OUTPUTS = {"original": "originals", "convert": "jpg", "watermark": "watermarked", "thumbnail": "thumbnails"}
+# Выходы, которые получаются из декодированного кадра (в процессе-воркере), в порядке обработки
+_DECODED_OUTPUTS = ("convert", "watermark", "thumbnail")
+
+
+def _encode_stats(profile):
+    return {"profile": profile, "bytes_in": 0, "bytes_out": 0, "encode_time": 0.0}
+
+
+def _add_encode_stats(stats, value):
+    """Суммирует байты на входе/выходе и время кодирования, которые вернул воркер."""
+    for key in ("bytes_in", "bytes_out", "encode_time"):
+        stats[key] += value[key]
+
+
+def format_encode_stats(stats):
+    """Строка для лога: сколько байт пришло и ушло и сколько заняло кодирование в профиле."""
+    mb_in = stats["bytes_in"] / 1024 / 1024
+    mb_out = stats["bytes_out"] / 1024 / 1024
+    return (f"📊 Профиль {stats['profile']}: {mb_in:.1f} МБ → {mb_out:.1f} МБ, "
+            f"кодирование {stats['encode_time']:.2f} сек")
+
+
+def format_archive_stats(stats):
+    """Строка для лога: сколько записей сохранено без сжатия и как сжались остальные."""
+    parts = []
+    for kind, title in (("stored", "без сжатия"), ("deflated", "DEFLATE"), ("copied", "перенесено сжатыми")):
+        entry = stats.get(kind)
+        if not entry:
+            continue
+        text = f"{title}: {entry['entries']} ({entry['bytes_in'] / 1024 / 1024:.1f} МБ"
+        if kind == "deflated":
+            ratio = entry["bytes_out"] / entry["bytes_in"] if entry["bytes_in"] else 1.0
+            text += f" → {entry['bytes_out'] / 1024 / 1024:.1f} МБ, {ratio:.0%}, {entry['time']:.2f} сек"
+        parts.append(text + ")")
+    line = "🗜️ Архив: " + "; ".join(parts)
+    if stats.get("saved_time"):
+        line += f"; без сжатия JPEG/WebP/HEIC сэкономлено ≈{stats['saved_time']:.2f} сек"
+    return line
+
+
+def _add_archive_stats(stats, result, log):
+    """Добавляет в статистику режима сводку по сжатию записей результата (только для ZIP)."""
+    archive = result.compression_stats()
+    if archive:
+        stats["archive"] = archive
+        log.append(format_archive_stats(archive))
+    return stats
+
+
+def _cached_jobs(func, jobs, cache, mode, params):
+    """Оборачивает задания (генератор) в cached_call, если передан кэш результатов."""
+    if cache is None:
+        return func, jobs
+    return cached_call, ((func, cache, mode, params, *job) for job in jobs)
+
+
+def _output_path(tmp, index):
+    """Промежуточный результат в отдельной папке, чтобы не перезаписать исходник."""
+    return os.path.join(tmp, OUTPUT_DIR, f"{index}.jpg")
+
+
+def _discard_output(path):
+    """Удаляет недописанный промежуточный файл после ошибки воркера."""
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+
+
+def _log_cache(cache, hits, total, log):
+    """Строка лога о попаданиях в кэш; после пакета кэш ужимается до бюджета."""
+    if cache is None:
+        return
+    removed, freed = cache.trim()
+    line = f"♻️ Из кэша: {hits} из {total}"
+    if removed:
+        line += f"; вытеснено записей: {removed} ({freed / 1024 / 1024:.1f} МБ)"
+    log.append(line)
+
+
+def _archive_output(result, path, arcname, value, metrics, copies=()):
+    """
+    Дописывает готовый файл в результат и учитывает замеры воркера и время архивации.
+    :param copies: Имена в результате для дубликатов исходника — тот же файл пишется и под ними
+    """
+    start = time.perf_counter()
+    for copy in copies:
+        result.add_file(path, copy)
+    result.add_file(path, arcname, remove=True)
+    if metrics:
+        metrics.add_stages(value["stages"])
+        metrics.add("archive", time.perf_counter() - start, value["bytes_out"] * (1 + len(copies)))
+        metrics.images += 1 + len(copies)
+
+
+def _dedup(sources, dedup, log, metrics):
+    """
+    Одинаковые по содержимому исходники обрабатываются один раз (dedup.find_duplicates).
+    :return: (индексы обрабатываемых исходников, {индекс: [индексы его дубликатов]})
+    """
+    if not dedup:
+        return list(range(len(sources))), {}
+    primary, duplicates, seconds = find_duplicates(sources)
+    if metrics:
+        metrics.add("dedup", seconds)
+    if duplicates:
+        log.append(f"♊ Дубликатов по содержимому: {len(sources) - len(primary)} — обрабатываются один раз, "
+                   f"результат копируется ({seconds:.2f} сек)")
+    return primary, duplicates
+
+
+def _resume(checkpoint, log):
+    """
+    Изображения, обработанные в прошлом запуске пакета (checkpoint.Checkpoint): их файлы уже в результате.
+    :return: {индекс: (value воркера, ошибка)}
+    """
+    if checkpoint is None:
+        return {}
+    done = checkpoint.completed()
+    if done:
+        log.append(f"⏯️ Продолжение пакета: готово в прошлом запуске — {len(done)}, они не обрабатываются заново")
+    return done
+
+
+def _run_pending(func, jobs, pending, done, finish, result, checkpoint, workers, on_progress):
+    """
+    Сначала учитывает изображения, обработанные в прошлом запуске (done; их файлы уже в result),
+    затем обрабатывает оставшиеся (pending; jobs — их задания по порядку) в пуле процессов.
+    :param finish: callback(index, value, error, elapsed, restored) для каждого изображения;
+                   restored — файлы изображения уже в результате, писать их не нужно
+    :param checkpoint: Checkpoint — каждое записанное изображение отмечается в манифесте
+    """
+    for index, (value, error) in sorted(done.items()):
+        finish(index, value, error, 0.0, True)
+    total = len(done) + len(pending)
+
+    def on_result(job_index, job, value, error, elapsed):
+        index = pending[job_index]
+        finish(index, value, error, elapsed, False)
+        if checkpoint:
+            checkpoint.mark(index, value, error, result.checkpoint_state())
+
+    def progress(count, _):
+        if on_progress:
+            on_progress(len(done) + count, total)
+
+    run_batch(func, jobs, workers=workers, on_progress=progress, on_result=on_result, total=len(pending))
+    if checkpoint:
+        checkpoint.finish()
+
+
+def _log_duplicates(log, sources, indices, rel_path):
+    """Строки лога для дубликатов rel_path, получивших копию его результата."""
+    for i in indices:
+        name = PurePosixPath(sources[i].name)
+        log.append(f"♊ {name} → {name.with_suffix('.jpg')}: копия результата {rel_path}")
+
+
+def _work_dir(work_dir):
+    """Папка для промежуточных файлов: переданная вызывающим или временная."""
+    if work_dir:
+        return contextlib.nullcontext(work_dir)
+    return tempfile.TemporaryDirectory()
+
+
+def _order_key(sources, order, log, metrics):
+    """
+    Ключ сортировки фото внутри папки для _rename_plan. Для "date" время съёмки читается
+    из заголовков всех фото сразу (capture_times), фото без времени идут в конце папки.
+    """
+    if order not in RENAME_ORDERS:
+        raise ValueError(f"Неизвестный порядок нумерации: {order}")
+    if order == "name":
+        return lambda src: PurePosixPath(src.name).name
+    times, from_exif, seconds = capture_times(sources)
+    if metrics:
+        metrics.add("exif", seconds)
+    log.append(f"🕒 Время съёмки: из EXIF {from_exif} из {len(sources)}, остальные — по времени файла "
+               f"({seconds:.2f} сек)")
+    moments = {id(src): moment for src, (moment, _) in zip(sources, times)}
+    return lambda src: (moments[id(src)] is None, moments[id(src)] or datetime.min, PurePosixPath(src.name).name)
+
+
+def _rename_plan(sources, key=None):
+    """
+    Последовательные имена по папкам: фото каждой папки, отсортированные по key (по умолчанию —
+    по имени), получают номера 1, 2, ... Если все фото лежат в одной корневой папке, в результат она не попадает.
+    :return: Список папок; папка — список (ImageSource, новый путь, имя в результате)
+    """
+    if key is None:
+        key = lambda x: PurePosixPath(x.name).name
+    folders = {}
+    for source in sources:
+        folders.setdefault(PurePosixPath(source.name).parent, []).append(source)
+    zip_root = PurePosixPath(".")
+    tops = {PurePosixPath(s.name).parts[0] if len(PurePosixPath(s.name).parts) > 1 else None for s in sources}
+    if len(tops) == 1 and None not in tops:
+        zip_root = PurePosixPath(tops.pop())
+    plan = []
+    for folder in sorted(folders):
+        photos_sorted = sorted(folders[folder], key=key)
+        entries = []
+        for idx, photo in enumerate(photos_sorted, 1):
+            relative_new_path = folder / f"{idx}{PurePosixPath(photo.name).suffix.lower()}"
+            entries.append((photo, relative_new_path, relative_new_path.relative_to(zip_root)))
+        plan.append(entries)
+    return plan
+
+
+def _copy_source(result, photo, arcname, metrics):
+    """
+    Копирует исходный файл в результат как есть: члены ZIP-архивов — сжатыми байтами,
+    без распаковки и повторного сжатия.
+    """
+    start = time.perf_counter()
+    member = photo.zip_member()
+    if member is not None:
+        result.copy_raw(*member, arcname)
+    else:
+        with photo.open(materialize=False) as fp:
+            result.add_stream(fp, arcname)
+    if metrics:
+        metrics.add("archive", time.perf_counter() - start, photo.size)
+
+
+def run_rename(sources, result, log, on_progress=None, metrics=None, order="name"):
+    """
+    Последовательно переименовывает фото в каждой папке (1.jpg, 2.jpg, ...) и пишет их в result.
+    Если все фото лежат в одной корневой папке, в результат она не попадает.
+    Пиксели не декодируются: члены ZIP-архивов переносятся в результат сжатыми байтами.
+    :param sources: Список ImageSource
+    :param result: ResultArchive или ResultDirectory
+    :param log: Список строк лога, дополняется
+    :param on_progress: callback(done, total) по папкам
+    :param metrics: BatchMetrics для замеров этапов (необязательно)
+    :param order: Порядок нумерации из RENAME_ORDERS: "name" — по имени файла, "date" — по времени съёмки
+    :return: Статистика {"total", "renamed", "skipped"} и "archive" — сводка сжатия (для ZIP)
+    """
+    renamed = 0
+    skipped = 0
+    # Папки строятся по путям внутри архивов — без записи файлов на диск
+    plan = _rename_plan(sources, _order_key(sources, order, log, metrics))
+    for i, folder in enumerate(plan, 1):
+        for photo, relative_new_path, arcname in folder:
+            # Байты копируются в результат сразу под новым именем
+            _copy_source(result, photo, arcname, metrics)
+            if metrics:
+                metrics.images += 1
+            log.append(f"Переименовано: '{PurePosixPath(photo.name)}' -> '{relative_new_path}'")
+            renamed += 1
+        if on_progress:
+            on_progress(i, len(plan))
+    return _add_archive_stats({"total": len(sources), "renamed": renamed, "skipped": skipped}, result, log)
+
+
+def run_convert(sources, result, log, workers=MAX_WORKERS, work_dir=None, on_progress=None, profile=DEFAULT_PROFILE,
+                metrics=None, cache=None, dedup=True, checkpoint=None):
+    """
+    Конвертирует изображения в JPEG в пуле процессов; каждый готовый файл сразу пишется в result.
+    :param work_dir: Папка для промежуточных файлов (по умолчанию — временная)
+    :param profile: Имя профиля кодирования из imaging.ENCODE_PROFILES
+    :param metrics: BatchMetrics для замеров этапов (необязательно)
+    :param cache: ResultCache — неизменившиеся изображения берутся из него (необязательно)
+    :param dedup: Одинаковые по содержимому файлы конвертировать один раз, остальным — копия результата
+    :param checkpoint: checkpoint.Checkpoint в work_dir — продолжить прерванный пакет (необязательно)
+    :return: Статистика {"total", "converted", "errors", "cache_hits", "duplicates", "resumed", "profile",
+             "bytes_in", "bytes_out", "encode_time"}
+    """
+    converted = 0
+    errors = 0
+    hits = 0
+    encode = _encode_stats(profile)
+    primary, duplicates = _dedup(sources, dedup, log, metrics)
+    with _work_dir(work_dir) as tmp:
+        done = _resume(checkpoint, log)
+        pending = [i for i in primary if i not in done]
+        # Задания создаются лениво: run_batch держит в работе лишь ограниченное окно,
+        # а каждый готовый файл сразу переносится в result и удаляется
+        func, jobs = _cached_jobs(
+            convert_file, ((sources[i], _output_path(tmp, i), profile) for i in pending),
+            cache, "convert", (profile,),
+        )
+
+        def finish(index, value, error, elapsed, restored):
+            nonlocal converted, errors, hits
+            rel_path = PurePosixPath(sources[index].name)
+            copies = duplicates.get(index, [])
+            if error is None:
+                if not restored:
+                    _archive_output(result, _output_path(tmp, index), rel_path.with_suffix('.jpg'), value, metrics,
+                                    [PurePosixPath(sources[i].name).with_suffix('.jpg') for i in copies])
+                hits += bool(value.get("cached"))
+                _add_encode_stats(encode, value)
+                converted += 1 + len(copies)
+                log.append(f"✅ {rel_path} → {rel_path.with_suffix('.jpg')}")
+                _log_duplicates(log, sources, copies, rel_path)
+            else:
+                _discard_output(_output_path(tmp, index))
+                log.append(f"❌ {rel_path}: ошибка конвертации ({error})")
+                errors += 1 + len(copies)
+
+        _run_pending(func, jobs, pending, done, finish, result, checkpoint, workers, on_progress)
+    log.append(format_encode_stats(encode))
+    _log_cache(cache, hits, len(primary), log)
+    stats = {"total": len(sources), "converted": converted, "errors": errors, "cache_hits": hits,
+             "duplicates": len(sources) - len(primary), "resumed": len(done), **encode}
+    return _add_archive_stats(stats, result, log)
+
+
+def run_watermark(sources, result, log, watermark_path, position="bottom_right", opacity=0.5, scale=0.2,
+                  workers=MAX_WORKERS, work_dir=None, on_progress=None, on_error=None, profile=DEFAULT_PROFILE,
+                  metrics=None, cache=None, tile_spacing=TILE_SPACING, tile_angle=TILE_ANGLE, text=None,
+                  text_options=None, dedup=True, checkpoint=None):
+    """
+    Накладывает водяной знак на изображения в пуле процессов; каждый готовый файл сразу пишется в result.
+    :param watermark_path: Картинка водяного знака; None — текстовый знак text
+    :param on_error: callback(rel_path, error) для ошибок отдельных файлов
+    :param profile: Имя профиля кодирования из imaging.ENCODE_PROFILES
+    :param metrics: BatchMetrics для замеров этапов (необязательно)
+    :param cache: ResultCache — неизменившиеся изображения берутся из него (необязательно)
+    :param tile_spacing: Промежуток между знаками для position="tile" (доля размера знака)
+    :param tile_angle: Угол поворота знаков для position="tile" (градусы)
+    :param text: Текст водяного знака (если нет watermark_path)
+    :param text_options: dict с font_path и color для текста
+    :param dedup: Одинаковые по содержимому файлы обрабатывать один раз, остальным — копия результата
+    :param checkpoint: checkpoint.Checkpoint в work_dir — продолжить прерванный пакет (необязательно)
+    :return: Статистика {"total", "processed", "errors", "cache_hits", "duplicates", "resumed", "profile",
+             "bytes_in", "bytes_out", "encode_time"}
+    """
+    processed = 0
+    errors = 0
+    hits = 0
+    encode = _encode_stats(profile)
+    primary, duplicates = _dedup(sources, dedup, log, metrics)
+    with _work_dir(work_dir) as tmp:
+        done = _resume(checkpoint, log)
+        pending = [i for i in primary if i not in done]
+        # Водяной знак входит в ключ кэша по содержимому, а не по пути
+        params = (file_digest(watermark_path) if cache and watermark_path else None, position, opacity, scale,
+                  profile, tile_spacing, tile_angle, text, sorted((text_options or {}).items()))
+        func, jobs = _cached_jobs(
+            watermark_file,
+            ((sources[i], _output_path(tmp, i), watermark_path, position, opacity, scale, profile, tile_spacing,
+              tile_angle, text, text_options)
+             for i in pending),
+            cache, "watermark", params,
+        )
+
+        def finish(index, value, error, elapsed, restored):
+            nonlocal processed, errors, hits
+            rel_path = PurePosixPath(sources[index].name)
+            copies = duplicates.get(index, [])
+            if error is None:
+                if not restored:
+                    _archive_output(result, _output_path(tmp, index), rel_path.with_suffix('.jpg'), value, metrics,
+                                    [PurePosixPath(sources[i].name).with_suffix('.jpg') for i in copies])
+                hits += bool(value.get("cached"))
+                _add_encode_stats(encode, value)
+                processed += 1 + len(copies)
+                log.append(f"✅ {rel_path} → {rel_path.with_suffix('.jpg')} (время: {elapsed:.2f} сек)")
+                _log_duplicates(log, sources, copies, rel_path)
+            else:
+                _discard_output(_output_path(tmp, index))
+                log.append(f"❌ {rel_path}: ошибка обработки водяного знака ({error}) (время: {elapsed:.2f} сек)")
+                if on_error:
+                    for i in [index, *copies]:
+                        on_error(PurePosixPath(sources[i].name), error)
+                errors += 1 + len(copies)
+
+        _run_pending(func, jobs, pending, done, finish, result, checkpoint, workers, on_progress)
+    log.append(format_encode_stats(encode))
+    _log_cache(cache, hits, len(primary), log)
+    stats = {"total": len(sources), "processed": processed, "errors": errors, "cache_hits": hits,
+             "duplicates": len(sources) - len(primary), "resumed": len(done), **encode}
+    return _add_archive_stats(stats, result, log)
+
+
+def run_combined(sources, result, log, outputs=tuple(COMBINED_OUTPUTS), rename=True, workers=MAX_WORKERS,
+                 work_dir=None, on_progress=None, profile=DEFAULT_PROFILE, metrics=None, watermark=None, order="name",
+                 dedup=True, checkpoint=None):
+    """
+    Несколько результатов за один проход: каждое изображение декодируется один раз, и из этого
+    кадра получаются все выбранные выходы. Всё пишется в один result по папкам COMBINED_OUTPUTS.
+    Выход "original" — исходные файлы без декодирования (члены ZIP переносятся сжатыми байтами).
+    :param outputs: Выходы из COMBINED_OUTPUTS
+    :param rename: Последовательные имена (1.jpg, 2.jpg, ... по папкам) во всех выходах
+    :param order: Порядок нумерации при rename (см. run_rename)
+    :param profile: Профиль кодирования для "convert" и "watermark"
+    :param watermark: dict параметров imaging.apply_watermark для выхода "watermark"
+    :param dedup: Одинаковые по содержимому фото декодировать один раз, остальным — копии выходов
+    :param checkpoint: checkpoint.Checkpoint в work_dir — продолжить прерванный пакет (необязательно)
+    :return: Статистика {"total", "processed", "errors", "decodes", "duplicates", "resumed", "outputs", "profile",
+             "bytes_in", "bytes_out", "encode_time"}; "outputs" — число файлов по выходам
+    """
+    unknown = set(outputs) - set(COMBINED_OUTPUTS)
+    if unknown:
+        raise ValueError(f"Неизвестные выходы: {', '.join(sorted(unknown))}")
+    if "watermark" in outputs and not (watermark and (watermark.get("watermark_path") or watermark.get("text"))):
+        raise ValueError("Для выхода watermark нужен водяной знак (картинка или текст)")
+    decoded = [name for name in _DECODED_OUTPUTS if name in outputs]
+    if rename:
+        plan = [(photo, arcname) for folder in _rename_plan(sources, _order_key(sources, order, log, metrics))
+                for photo, _, arcname in folder]
+    else:
+        plan = [(source, PurePosixPath(source.name)) for source in sources]
+    # Без декодируемых выходов искать дубликаты незачем: исходники переносятся как есть
+    primary, duplicates = _dedup([photo for photo, _ in plan], dedup and bool(decoded), log, metrics)
+    counts = {name: 0 for name in COMBINED_OUTPUTS if name in outputs}
+    processed = 0
+    errors = 0
+    encode = _encode_stats(profile)
+    done = {}
+    with _work_dir(work_dir) as tmp:
+
+        def dsts(index):
+            return {name: os.path.join(tmp, OUTPUT_DIR, f"{index}-{name}.jpg") for name in decoded}
+
+        def add_original(index, restored=False):
+            photo, arcname = plan[index]
+            if "original" in outputs:
+                if not restored:
+                    _copy_source(result, photo, COMBINED_OUTPUTS["original"] / arcname, metrics)
+                counts["original"] += 1
+
+        def finish(index, value, error, elapsed, restored):
+            nonlocal processed, errors
+            photo, arcname = plan[index]
+            rel_path = PurePosixPath(photo.name)
+            copies = duplicates.get(index, [])
+            for i in [index, *copies]:
+                add_original(i, restored)
+            if error is None:
+                start = time.perf_counter()
+                for name, path in dsts(index).items():
+                    if not restored:
+                        for i in copies:
+                            result.add_file(path, COMBINED_OUTPUTS[name] / plan[i][1].with_suffix('.jpg'))
+                        result.add_file(path, COMBINED_OUTPUTS[name] / arcname.with_suffix('.jpg'), remove=True)
+                    counts[name] += 1 + len(copies)
+                if metrics and not restored:
+                    metrics.add_stages(value["stages"])
+                    metrics.add("archive", time.perf_counter() - start, value["bytes_out"] * (1 + len(copies)))
+                    metrics.images += 1 + len(copies)
+                _add_encode_stats(encode, value)
+                processed += 1 + len(copies)
+                log.append(f"✅ {rel_path} → {arcname.with_suffix('.jpg')} ({', '.join(decoded)}, {elapsed:.2f} сек)")
+                for i in copies:
+                    log.append(f"♊ {PurePosixPath(plan[i][0].name)} → {plan[i][1].with_suffix('.jpg')}: "
+                               f"копия результата {rel_path}")
+            else:
+                for path in dsts(index).values():
+                    _discard_output(path)
+                log.append(f"❌ {rel_path}: ошибка обработки ({error})")
+                errors += 1 + len(copies)
+
+        if decoded:
+            done = _resume(checkpoint, log)
+            pending = [i for i in primary if i not in done]
+            jobs = ((plan[i][0], dsts(i), profile, watermark) for i in pending)
+            _run_pending(multi_output_file, jobs, pending, done, finish, result, checkpoint, workers, on_progress)
+        else:
+            # Только исходники: декодировать нечего
+            for index, (photo, arcname) in enumerate(plan):
+                add_original(index)
+                if metrics:
+                    metrics.images += 1
+                log.append(f"✅ {PurePosixPath(photo.name)} → {arcname}")
+                processed += 1
+                if on_progress:
+                    on_progress(index + 1, len(plan))
+    # Одно декодирование на уникальное фото (включая неудачные), сколько бы выходов из него ни получалось
+    decodes = len(primary) if decoded else 0
+    if decoded:
+        log.append(format_encode_stats(encode))
+        log.append(f"🔀 Один проход: {decodes} декодирований на {len(plan)} фото, выходов на фото: {len(outputs)}")
+    stats = {"total": len(sources), "processed": processed, "errors": errors, "decodes": decodes,
+             "duplicates": len(sources) - len(primary), "resumed": len(done), "outputs": counts, **encode}
+    return _add_archive_stats(stats, result, log)
@@ -0,0 +1,64 @@
+# dedup.py
+# Одинаковые изображения внутри пакета (пересекающиеся архивы, повторно загруженные фото).
+# Хэш содержимого считается только для кандидатов: файлов с совпадающим размером, а для
+# членов ZIP — ещё и с совпадающей CRC из центрального каталога (её не нужно вычислять).
+import time
+from collections import defaultdict
+from ingest import map_chunked
+from result_cache import source_digest
+
+# Потоков для хэширования кандидатов: работа упирается в чтение и распаковку
+DEDUP_THREADS = 8
+
+
+def _prefilter_key(src):
+    """Размер и CRC-32 (для членов ZIP; иначе None) — дубликаты обязаны совпасть по обоим."""
+    member = src.zip_member()
+    if member is not None:
+        return member[1].file_size, member[1].CRC
+    return src.size, None
+
+
+def _candidates(sources):
+    """
+    Индексы файлов, у которых может найтись дубликат. Внутри группы одного размера CRC
+    отсекает члены ZIP, только если CRC известна у всех файлов группы.
+    """
+    by_size = defaultdict(list)
+    for index, src in enumerate(sources):
+        size, crc = _prefilter_key(src)
+        by_size[size].append((index, crc))
+    candidates = []
+    for group in by_size.values():
+        if len(group) < 2:
+            continue
+        if any(crc is None for _, crc in group):
+            candidates.extend(index for index, _ in group)
+            continue
+        by_crc = defaultdict(list)
+        for index, crc in group:
+            by_crc[crc].append(index)
+        candidates.extend(index for indices in by_crc.values() if len(indices) > 1 for index in indices)
+    return sorted(candidates)
+
+
+def find_duplicates(sources, threads=DEDUP_THREADS):
+    """
+    Группирует одинаковые по содержимому ImageSource. Первое вхождение остаётся основным,
+    остальные обрабатывать не нужно — их результат копируется с основного.
+    :return: (индексы основных файлов по порядку, {индекс основного: [индексы его дубликатов]}, секунд)
+    """
+    start = time.perf_counter()
+    candidates = _candidates(sources)
+    duplicates = {}
+    if candidates:
+        digests = map_chunked(source_digest, [sources[i] for i in candidates], threads, "photoflow-dedup")
+        first = {}
+        for index, digest in zip(candidates, digests):
+            if digest in first:
+                duplicates.setdefault(first[digest], []).append(index)
+            else:
+                first[digest] = index
+    skipped = {index for indices in duplicates.values() for index in indices}
+    primary = [index for index in range(len(sources)) if index not in skipped]
+    return primary, duplicates, time.perf_counter() - start
@@ -0,0 +1,435 @@
+# imaging.py
+# Операции над отдельными изображениями без зависимости от интерфейса Streamlit:
+# используются и приложением, и CLI, и процессами-воркерами пула.
+import os
+import math
+import time
+import hashlib
+import threading
+from io import BytesIO
+from collections import OrderedDict
+from PIL import Image, ImageOps, ImageFont, ImageDraw
+from utils import ensure_heif_support, HEIF_EXTS
+from metrics import StageTimer, decode_stage
+
+# Профили JPEG-кодирования результата. max_edge — ограничение длинной стороны (None — без уменьшения).
+# "archival" повторяет прежние настройки сохранения.
+ENCODE_PROFILES = {
+    "archival": {"quality": 100, "subsampling": 2, "optimize": True, "progressive": True, "max_edge": None},
+    "web": {"quality": 82, "subsampling": 2, "optimize": True, "progressive": True, "max_edge": 2560},
+    "fast": {"quality": 85, "subsampling": 2, "optimize": False, "progressive": False, "max_edge": None},
+    "thumbnail": {"quality": 80, "subsampling": 2, "optimize": True, "progressive": True, "max_edge": 800},
+}
+DEFAULT_PROFILE = "archival"
+# Профиль выхода "thumbnail" в комбинированном режиме (multi_output_file)
+THUMBNAIL_PROFILE = "thumbnail"
+
+# Сколько подготовленных (масштабированных) водяных знаков держать в памяти
+WATERMARK_CACHE_SIZE = 16
+# Сколько исходных файлов водяных знаков держать открытыми
+WATERMARK_SOURCE_CACHE_SIZE = 4
+
+# Сколько готовых слоёв "плитки" (во весь кадр) держать в памяти: слой 12 Мп RGBA занимает ~48 МБ
+TILE_CACHE_SIZE = 2
+# Параметры положения "tile": промежуток между знаками (доля размера знака) и угол поворота (градусы)
+TILE_SPACING = 0.5
+TILE_ANGLE = 30.0
+# Шрифт текстового знака по умолчанию (ищется в системных папках шрифтов); без него — встроенный шрифт Pillow
+DEFAULT_FONT = "DejaVuSans.ttf"
+DEFAULT_TEXT_COLOR = (255, 255, 255)
+# Кегль, на котором измеряется ширина текста перед подбором размера
+_FONT_MEASURE_SIZE = 100
+FONT_CACHE_SIZE = 8
+
+_wm_source_cache = OrderedDict()
+_wm_prepared_cache = OrderedDict()
+_tile_cache = OrderedDict()
+_font_cache = OrderedDict()
+# Кэши общие для потоков процесса: предпросмотр разных сессий и фоновые задания
+_cache_lock = threading.Lock()
+
+
+def _watermark_source_key(watermark_path):
+    """Ключ источника водяного знака: путь+mtime для файлов, хэш содержимого для BytesIO."""
+    if isinstance(watermark_path, BytesIO):
+        return ("bytes", hashlib.blake2b(watermark_path.getvalue(), digest_size=16).hexdigest())
+    path = os.path.abspath(os.fspath(watermark_path))
+    stat = os.stat(path)
+    return ("file", path, stat.st_mtime_ns, stat.st_size)
+
+
+def _cache_get(cache, key):
+    with _cache_lock:
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+
+
+def _cache_put(cache, key, value, limit):
+    with _cache_lock:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > limit:
+            cache.popitem(last=False)
+
+
+def _opacity_lut(opacity):
+    """Таблица для Image.point: альфа-канал умножается на opacity без вызова lambda на каждый пиксель."""
+    return [int(p * opacity) for p in range(256)]
+
+
+def get_prepared_watermark(watermark_path, width: int, opacity: float) -> Image.Image:
+    """
+    Возвращает водяной знак, приведённый к RGBA, отмасштабированный до ширины width
+    и с уже применённой прозрачностью. Результат кэшируется (LRU) по ключу
+    (источник, ширина, прозрачность), поэтому в пакете фото одного разрешения
+    знак загружается и масштабируется один раз. Возвращаемое изображение нельзя изменять.
+    """
+    return _prepared_watermark(watermark_path, width, opacity)[0]
+
+
+def _prepared_watermark(watermark_path, width, opacity):
+    """get_prepared_watermark вместе с ключом кэша — источник знака проверяется один раз на фото."""
+    source_key = _watermark_source_key(watermark_path)
+    key = (source_key, width, opacity)
+    wm = _cache_get(_wm_prepared_cache, key)
+    if wm is not None:
+        return wm, key
+    src = _cache_get(_wm_source_cache, source_key)
+    if src is None:
+        if isinstance(watermark_path, BytesIO):
+            watermark_path.seek(0)
+        src = Image.open(watermark_path).convert("RGBA")
+        _cache_put(_wm_source_cache, source_key, src, WATERMARK_SOURCE_CACHE_SIZE)
+    # Масштабирование
+    wm_ratio = width / src.width
+    wm_height = int(src.height * wm_ratio)
+    wm = src.resize((width, wm_height), Image.Resampling.LANCZOS)
+    # Применение прозрачности
+    if opacity < 1.0:
+        wm.putalpha(wm.getchannel("A").point(_opacity_lut(opacity)))
+    _cache_put(_wm_prepared_cache, key, wm, WATERMARK_CACHE_SIZE)
+    return wm, key
+
+
+def _load_font(font_path, size):
+    """Шрифт нужного кегля из кэша; при ошибке загрузки — DEFAULT_FONT, затем встроенный шрифт Pillow."""
+    key = (font_path, size)
+    font = _cache_get(_font_cache, key)
+    if font is not None:
+        return font
+    for path in (font_path, DEFAULT_FONT):
+        if not path:
+            continue
+        try:
+            font = ImageFont.truetype(path, size)
+            break
+        except OSError:
+            continue
+    else:
+        font = ImageFont.load_default(size)
+    _cache_put(_font_cache, key, font, FONT_CACHE_SIZE)
+    return font
+
+
+def _text_watermark_key(text, opts, width, opacity):
+    color = tuple(opts.get("color") or DEFAULT_TEXT_COLOR)[:3]
+    return ("text", text, opts.get("font_path"), color, width, opacity)
+
+
+def get_text_watermark(text, width: int, opacity: float, text_options=None) -> Image.Image:
+    """
+    Текстовый водяной знак RGBA шириной около width: кегль подбирается по ширине текста,
+    глифы растрируются один раз. Результат кэшируется (LRU) вместе с картинками-знаками
+    по (текст, шрифт, цвет, ширина, прозрачность), так что в пакете фото одного
+    разрешения текст растрируется один раз. Возвращаемое изображение нельзя изменять.
+    :param text_options: dict с font_path (TTF/OTF) и color (RGB)
+    """
+    opts = text_options or {}
+    key = _text_watermark_key(text, opts, width, opacity)
+    wm = _cache_get(_wm_prepared_cache, key)
+    if wm is not None:
+        return wm
+    font_path = opts.get("font_path")
+    # Подбор кегля: ширина текста пропорциональна кеглю
+    measure_width = _load_font(font_path, _FONT_MEASURE_SIZE).getlength(text) or 1
+    font = _load_font(font_path, max(10, int(_FONT_MEASURE_SIZE * width / measure_width)))
+    left, top, right, bottom = font.getbbox(text)
+    color = tuple(opts.get("color") or DEFAULT_TEXT_COLOR)[:3] + (int(255 * opacity),)
+    wm = Image.new("RGBA", (max(1, right - left), max(1, bottom - top)), (0, 0, 0, 0))
+    ImageDraw.Draw(wm).text((-left, -top), text, font=font, fill=color)
+    _cache_put(_wm_prepared_cache, key, wm, WATERMARK_CACHE_SIZE)
+    return wm
+
+
+def get_tiled_overlay(wm, wm_key, size, spacing=TILE_SPACING, angle=TILE_ANGLE) -> Image.Image:
+    """
+    Слой во весь кадр size с повторяющимся повёрнутым знаком: ряды со сдвигом на полшага
+    дают диагональный узор. Слой строится один раз на (знак, размер кадра, промежуток, угол)
+    и кэшируется (LRU), поэтому каждое фото получает одно наложение вместо десятков вставок.
+    Возвращаемое изображение нельзя изменять.
+    :param wm: Подготовленный знак RGBA (см. get_prepared_watermark)
+    :param wm_key: Ключ подготовленного знака для кэша
+    :param spacing: Промежуток между знаками в долях размера повёрнутого знака
+    :param angle: Угол поворота знака в градусах (против часовой стрелки)
+    """
+    key = (wm_key, tuple(size), spacing, angle)
+    overlay = _cache_get(_tile_cache, key)
+    if overlay is not None:
+        return overlay
+    tile = wm.rotate(angle, resample=Image.Resampling.BICUBIC, expand=True) if angle else wm
+    step_x = max(1, int(tile.width * (1 + spacing)))
+    step_y = max(1, int(tile.height * (1 + spacing)))
+    overlay = Image.new("RGBA", tuple(size), (0, 0, 0, 0))
+    for row, y in enumerate(range(0, size[1], step_y)):
+        # Нечётные ряды сдвинуты на полшага и начинаются за левым краем, чтобы не было пустой полосы
+        x0 = -(step_x // 2) if row % 2 else 0
+        for x in range(x0, size[0], step_x):
+            # Шаг не меньше размера знака — знаки не перекрываются, смешивание не нужно
+            overlay.paste(tile, (x, y))
+    _cache_put(_tile_cache, key, overlay, TILE_CACHE_SIZE)
+    return overlay
+
+
+def apply_watermark(
+    base_image: Image.Image,
+    watermark_path: str = None,
+    text: str = None,
+    position: str = "bottom_right",
+    opacity: float = 0.5,
+    scale: float = 0.2,
+    in_place: bool = False,
+    tile_spacing: float = TILE_SPACING,
+    tile_angle: float = TILE_ANGLE,
+    text_options: dict = None,
+) -> Image.Image:
+    """
+    Накладывает водяной знак (PNG или текст) на изображение.
+    :param base_image: Исходное изображение (PIL.Image)
+    :param watermark_path: Путь к PNG-водяном знаку (или BytesIO, или None)
+    :param text: Текст для текстового водяного знака (или None)
+    :param position: Позиция ('top_left', 'top_right', 'center', 'bottom_left', 'bottom_right'
+                     или 'tile' — повторяющийся знак по всему кадру)
+    :param opacity: Прозрачность (0.0-1.0)
+    :param scale: Масштаб водяного знака относительно ширины base_image (0.0-1.0)
+    :param text_options: dict с параметрами текста (font_path, color)
+    :param in_place: Разрешить изменить base_image, если он уже в RGB (без копии кадра)
+    :param tile_spacing: Промежуток между знаками для 'tile' (доля размера знака)
+    :param tile_angle: Угол поворота знаков для 'tile' (градусы)
+    :return: Изображение RGB с водяным знаком
+    """
+    assert watermark_path or text, "Нужно указать watermark_path или text"
+    if base_image.mode != "RGB":
+        img = base_image.convert("RGB")
+    else:
+        img = base_image if in_place else base_image.copy()
+    wm = None
+    wm_key = None
+    if watermark_path:
+        # Подготовленный знак берётся из кэша (поддерживаются путь и BytesIO)
+        wm, wm_key = _prepared_watermark(watermark_path, int(img.width * scale), opacity)
+    elif text:
+        opts = text_options or {}
+        wm_key = _text_watermark_key(text, opts, int(img.width * scale), opacity)
+        wm = get_text_watermark(text, int(img.width * scale), opacity, opts)
+    else:
+        raise ValueError("Не указан водяной знак")
+    if position == "tile":
+        overlay = get_tiled_overlay(wm, wm_key, img.size, tile_spacing, tile_angle)
+        img.paste(overlay, (0, 0), overlay)
+        return img
+    # Позиционирование
+    positions = {
+        "top_left": (0, 0),
+        "top_right": (img.width - wm.width, 0),
+        "center": ((img.width - wm.width) // 2, (img.height - wm.height) // 2),
+        "bottom_left": (0, img.height - wm.height),
+        "bottom_right": (img.width - wm.width, img.height - wm.height),
+    }
+    pos = positions.get(position, positions["bottom_right"])
+    # Смешивание только в области знака: paste с альфой знака в качестве маски
+    # (то же, что alpha_composite по непрозрачному фону); части за краем кадра отсекаются
+    img.paste(wm, pos, wm)
+    return img
+
+def fit_to_profile(img, profile=DEFAULT_PROFILE):
+    """Уменьшает изображение (на месте) до max_edge профиля, если оно больше."""
+    max_edge = ENCODE_PROFILES[profile]["max_edge"]
+    if max_edge and max(img.size) > max_edge:
+        img.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+    return img
+
+
+def decode_image(fp, suffix, max_edge=None):
+    """
+    Декодирует изображение с учётом формата. HEIC/HEIF читаются напрямую через pillow-heif
+    (многопоточное декодирование libheif, без карт глубины); для JPEG при уменьшении
+    draft() масштабирует прямо в декодере, но не меньше, чем нужно для max_edge.
+    ICC-профиль и EXIF остаются в img.info.
+    """
+    if suffix in HEIF_EXTS and ensure_heif_support():
+        import pillow_heif
+        return pillow_heif.open_heif(fp, convert_hdr_to_8bit=True).to_pillow()
+    img = Image.open(fp)
+    if max_edge and img.format == "JPEG" and max(img.size) > max_edge:
+        ratio = max_edge / max(img.size)
+        img.draft(img.mode, (math.ceil(img.width * ratio), math.ceil(img.height * ratio)))
+    img.load()
+    return img
+
+
+def _rgb_icc_profile(img):
+    """
+    ICC-профиль исходника, если он подходит для RGB JPEG. Профиль CMYK или серого описывает
+    другое число каналов: после convert("RGB") с ним цвета искажаются, а часть просмотрщиков
+    отвергает файл. Такой профиль отбрасывается — данные читаются как sRGB. Пространство
+    профиля берётся из его заголовка (байты 16-20).
+    """
+    icc_profile = img.info.get('icc_profile')
+    if icc_profile and icc_profile[16:20] == b'RGB ':
+        return icc_profile
+    return None
+
+
+def encode_jpeg(img, dst, profile=DEFAULT_PROFILE, icc_profile=None, exif=None):
+    """
+    Сохраняет изображение в JPEG с настройками профиля.
+    :param icc_profile: ICC-профиль исходника (если был)
+    :param exif: EXIF исходника в байтах (если был)
+    :return: (размер файла в байтах, время кодирования в секундах)
+    """
+    opts = ENCODE_PROFILES[profile]
+    start = time.perf_counter()
+    img.save(
+        dst, "JPEG",
+        quality=opts["quality"],
+        subsampling=opts["subsampling"],
+        optimize=opts["optimize"],
+        progressive=opts["progressive"],
+        icc_profile=icc_profile,
+        exif=exif or b"",
+    )
+    return os.path.getsize(dst), time.perf_counter() - start
+
+
+def watermark_file(src, dst, watermark_path, position, opacity, scale, profile=DEFAULT_PROFILE,
+                   tile_spacing=TILE_SPACING, tile_angle=TILE_ANGLE, text=None, text_options=None):
+    """
+    Накладывает водяной знак на одно изображение (ImageSource) и сохраняет JPEG (выполняется в процессе-воркере).
+    Знак — картинка watermark_path или, если её нет, текст text с параметрами text_options.
+    :return: dict с bytes_in, bytes_out, encode_time и замерами этапов stages
+    """
+    ensure_heif_support()
+    timer = StageTimer()
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    with timer.stage("read", src.size):
+        fp = src.open()
+    with fp:
+        with timer.stage(decode_stage(src.suffix)):
+            img = decode_image(fp, src.suffix, ENCODE_PROFILES[profile]["max_edge"])
+    # Знак ставится на изображение в том виде, как его покажет просмотрщик; тег ориентации сбрасывается
+    ImageOps.exif_transpose(img, in_place=True)
+    icc_profile = _rgb_icc_profile(img)
+    exif = img.info.get('exif')
+    with timer.stage("composite"):
+        processed_img = apply_watermark(
+            fit_to_profile(img, profile),
+            watermark_path=watermark_path,
+            position=position,
+            opacity=opacity,
+            scale=scale,
+            in_place=True,
+            tile_spacing=tile_spacing,
+            tile_angle=tile_angle,
+            text=text,
+            text_options=text_options,
+        )
+    bytes_out, encode_time = encode_jpeg(processed_img, dst, profile, icc_profile=icc_profile, exif=exif)
+    timer.add("encode", encode_time, bytes_out)
+    return {"bytes_in": src.size, "bytes_out": bytes_out, "encode_time": encode_time, "stages": timer.as_dict()}
+
+
+def convert_file(src, dst, profile=DEFAULT_PROFILE):
+    """
+    Конвертирует одно изображение (ImageSource) в JPEG (выполняется в процессе-воркере).
+    :return: dict с bytes_in, bytes_out, encode_time и замерами этапов stages
+    """
+    ensure_heif_support()
+    timer = StageTimer()
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    with timer.stage("read", src.size):
+        fp = src.open()
+    with fp:
+        with timer.stage(decode_stage(src.suffix)):
+            img = decode_image(fp, src.suffix, ENCODE_PROFILES[profile]["max_edge"])
+    icc_profile = _rgb_icc_profile(img)
+    exif = img.info.get('exif')
+    with timer.stage("convert"):
+        img = fit_to_profile(img.convert("RGB"), profile)
+    bytes_out, encode_time = encode_jpeg(img, dst, profile, icc_profile=icc_profile, exif=exif)
+    timer.add("encode", encode_time, bytes_out)
+    return {"bytes_in": src.size, "bytes_out": bytes_out, "encode_time": encode_time, "stages": timer.as_dict()}
+
+
+def _scaled_frame(frames, max_edge):
+    """
+    Кадр, уменьшенный до max_edge по длинной стороне. frames — уже готовые кадры по max_edge
+    (None — полный кадр): выходы с одинаковым размером делят один кадр, а меньший кадр
+    получается из ближайшего большего, а не из полного.
+    """
+    if max_edge in frames:
+        return frames[max_edge]
+    base = frames[None]
+    if max(base.size) <= max_edge:
+        frame = base
+    else:
+        src = min((f for f in frames.values() if max(f.size) >= max_edge), key=lambda f: f.width * f.height)
+        ratio = max_edge / max(src.size)
+        size = (max(1, round(src.width * ratio)), max(1, round(src.height * ratio)))
+        frame = src.resize(size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+    frames[max_edge] = frame
+    return frame
+
+
+def multi_output_file(src, dsts, profile=DEFAULT_PROFILE, watermark=None):
+    """
+    Декодирует одно изображение (ImageSource) один раз и сохраняет из него несколько JPEG
+    (выполняется в процессе-воркере). Ориентация EXIF и RGB применяются один раз,
+    уменьшенные кадры общие для выходов одного размера (см. _scaled_frame).
+    :param dsts: {выход: путь} — "convert", "watermark" и/или "thumbnail"
+    :param profile: Профиль для "convert" и "watermark"; "thumbnail" кодируется в THUMBNAIL_PROFILE
+    :param watermark: dict параметров apply_watermark (watermark_path или text, position, opacity, scale, ...)
+    :return: dict с bytes_in, bytes_out и encode_time (по всем выходам), outputs {выход: байт} и stages
+    """
+    ensure_heif_support()
+    timer = StageTimer()
+    profiles = {name: THUMBNAIL_PROFILE if name == "thumbnail" else profile for name in dsts}
+    # Если все выходы уменьшаются, JPEG можно декодировать сразу в меньшем масштабе
+    edges = [ENCODE_PROFILES[p]["max_edge"] for p in profiles.values()]
+    max_edge = None if None in edges else max(edges)
+    with timer.stage("read", src.size):
+        fp = src.open()
+    with fp:
+        with timer.stage(decode_stage(src.suffix)):
+            img = decode_image(fp, src.suffix, max_edge)
+    ImageOps.exif_transpose(img, in_place=True)
+    icc_profile = _rgb_icc_profile(img)
+    exif = img.info.get('exif')
+    with timer.stage("convert"):
+        frames = {None: img if img.mode == "RGB" else img.convert("RGB")}
+    outputs = {}
+    encode_time = 0.0
+    # Водяной знак — последним: знак накладывается на общий кадр на месте, после него кадр не нужен
+    for name in sorted(dsts, key=lambda n: n == "watermark"):
+        with timer.stage("resize"):
+            frame = _scaled_frame(frames, ENCODE_PROFILES[profiles[name]]["max_edge"])
+        if name == "watermark":
+            with timer.stage("composite"):
+                frame = apply_watermark(frame, in_place=True, **watermark)
+        os.makedirs(os.path.dirname(dsts[name]), exist_ok=True)
+        outputs[name], seconds = encode_jpeg(frame, dsts[name], profiles[name], icc_profile=icc_profile, exif=exif)
+        timer.add("encode", seconds, outputs[name])
+        encode_time += seconds
+    return {"bytes_in": src.size, "bytes_out": sum(outputs.values()), "encode_time": encode_time,
+            "outputs": outputs, "stages": timer.as_dict()}
@@ -0,0 +1,346 @@
+# ingest.py
+import os
+import io
+import ntpath
+import shutil
+import zipfile
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
+from utils import SUPPORTED_EXTS
+
+# Форматы, которым для декодирования нужен произвольный доступ (seek) по файлу:
+# такие члены архива сначала копируются во временный файл
+SEEKABLE_EXTS = ('.tiff', '.heic', '.heif')
+# До этого размера временная копия держится в памяти, дальше уходит на диск
+SPOOL_MAX_BYTES = 32 * 1024 * 1024
+# Сколько открытых ZIP-архивов держать в кэше одного процесса
+ZIP_CACHE_SIZE = 8
+
+# Открытые архивы свои у каждого потока: фоновые задания не закрывают архивы друг друга
+_local = threading.local()
+
+
+def _open_zips():
+    if not hasattr(_local, "zips"):
+        _local.zips = OrderedDict()
+    return _local.zips
+
+
+def _zip_for(archive):
+    """
+    Открытый ZipFile для архива (путь или файловый объект). Архив открывается
+    один раз на поток, чтобы центральный каталог не читался для каждого файла.
+    """
+    zips = _open_zips()
+    key = archive if isinstance(archive, str) else id(archive)
+    entry = zips.get(key)
+    if entry is not None:
+        zips.move_to_end(key)
+        return entry[1]
+    zf = zipfile.ZipFile(archive, "r")
+    # Сам объект архива храним рядом, чтобы id() не переиспользовался
+    zips[key] = (archive, zf)
+    while len(zips) > ZIP_CACHE_SIZE:
+        _, (_, old) = zips.popitem(last=False)
+        old.close()
+    return zf
+
+
+class ImageSource:
+    """
+    Изображение для обработки: отдельный файл на диске или член ZIP-архива.
+    Члены архива не извлекаются — они читаются потоком прямо из архива при open().
+    :param name: Относительный путь изображения (используется в логе и в архиве результата)
+    :param path: Путь к файлу на диске (для отдельных файлов)
+    :param archive: Путь к ZIP-архиву или файловый объект (для членов архива)
+    :param member: Имя члена архива
+    :param fileobj: Загруженный файл в памяти (для отдельных файлов без записи на диск)
+    """
+
+    __slots__ = ("name", "path", "archive", "member", "fileobj", "size")
+
+    def __init__(self, name, path=None, archive=None, member=None, fileobj=None, size=0):
+        self.name = name
+        self.path = path
+        self.archive = archive
+        self.member = member
+        self.fileobj = fileobj
+        self.size = size
+
+    @property
+    def suffix(self):
+        return PurePosixPath(self.name).suffix.lower()
+
+    def zip_member(self):
+        """
+        Для члена ZIP-архива — (открытый ZipFile, ZipInfo) из центрального каталога, иначе None.
+        Нужно для копирования сжатых байтов без распаковки (ResultArchive.copy_raw).
+        """
+        if self.archive is None:
+            return None
+        zf = _zip_for(self.archive)
+        return zf, zf.getinfo(self.member)
+
+    def open(self, materialize=True):
+        """
+        Открывает изображение как бинарный поток.
+        :param materialize: Копировать во временный файл форматы, которым нужен seek (для Image.open);
+                            False — для простого копирования байтов
+        """
+        if self.path is not None:
+            return open(self.path, "rb")
+        if self.fileobj is not None:
+            # Отдельный поток поверх тех же байтов: закрытие не затрагивает саму загрузку
+            return io.BytesIO(self.fileobj.getvalue())
+        stream = _zip_for(self.archive).open(self.member)
+        if not materialize or self.suffix not in SEEKABLE_EXTS:
+            return stream
+        # Материализуем только форматы, которым нужен произвольный доступ
+        spooled = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+        with stream:
+            shutil.copyfileobj(stream, spooled)
+        spooled.seek(0)
+        return spooled
+
+    def as_dict(self):
+        """Описание для записи в JSON (ImageSource(**d) восстанавливает); только для файлов на диске."""
+        return {"name": self.name, "path": self.path, "archive": self.archive, "member": self.member,
+                "size": self.size}
+
+    def __repr__(self):
+        return f"ImageSource({self.name!r})"
+
+
+def safe_member_name(filename):
+    """
+    Относительный путь члена архива, очищенный как в ZipFile.extract(): без диска, ведущего "/"
+    и частей "." и "..", — имя в результате не выходит за его пределы.
+    :return: Путь через "/" или None, если от имени ничего не осталось
+    """
+    name = filename.replace("\\", "/")
+    name = ntpath.splitdrive(name)[1]
+    parts = [part for part in name.split("/") if part not in ("", ".", "..")]
+    return "/".join(parts) or None
+
+
+def _member_name(info, root, log, archive_name):
+    """Имя изображения из архива в результате (с корневой папкой архива) или None, если член пропущен."""
+    rel = safe_member_name(info.filename)
+    if rel is None:
+        log.append(f"❌ {archive_name}: {info.filename!r} — недопустимое имя, пропущено.")
+        return None
+    if rel != info.filename:
+        log.append(f"⚠️ {archive_name}: {info.filename!r} сохранён как {rel!r}.")
+    return str(PurePosixPath(root, rel)) if root else rel
+
+
+def iter_zip_images(zf):
+    """Члены архива с поддерживаемыми расширениями — только по центральному каталогу, без чтения данных."""
+    for info in zf.infolist():
+        if not info.is_dir() and info.filename.lower().endswith(SUPPORTED_EXTS):
+            yield info
+
+
+def spool_upload(uploaded, spool_dir, index=0):
+    """
+    Записывает загруженный файл на диск одним последовательным проходом
+    (нужно, чтобы его могли читать процессы-воркеры) и возвращает путь.
+    :param index: Номер загрузки — загрузки с одинаковыми именами не затирают друг друга
+    """
+    path = os.path.join(spool_dir, "_uploads", str(index), os.path.basename(uploaded.name))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    uploaded.seek(0)
+    with open(path, "wb") as f:
+        shutil.copyfileobj(uploaded, f)
+    return path
+
+
+class ArchiveManifest:
+    """
+    Изображения одного загруженного архива, взятые из его собственного списка членов.
+    :param name: Имя загруженного архива
+    :param root: Папка, под которой изображения архива попадут в результат ("" — в корень)
+    :param sources: Список ImageSource
+    """
+
+    __slots__ = ("name", "root", "sources")
+
+    def __init__(self, name, root="", sources=None):
+        self.name = name
+        self.root = root
+        self.sources = sources or []
+
+
+def _unique_roots(names):
+    """
+    Корневые папки источников в результате: при нескольких источниках каждый получает
+    свою папку по своему имени, чтобы одинаковые пути внутри них не пересекались.
+    """
+    if len(names) < 2:
+        return [""] * len(names)
+    roots = []
+    used = set()
+    for name in names:
+        stem = PurePosixPath(name).stem
+        root = stem
+        n = 2
+        while root in used:
+            root = f"{stem}_{n}"
+            n += 1
+        used.add(root)
+        roots.append(root)
+    return roots
+
+
+def collect_manifests(uploaded_files, log, spool_dir=None):
+    """
+    Собирает манифесты загруженных архивов без распаковки: изображения каждого архива
+    берутся только из его центрального каталога, поэтому каждый архив просматривается один раз.
+    Отдельные файлы собираются в манифест с пустым именем.
+    :return: Список ArchiveManifest
+    """
+    roots = _unique_roots([u.name for u in uploaded_files if u.name.lower().endswith(".zip")])
+    manifests = []
+    loose = ArchiveManifest("")
+    archive_index = 0
+    for index, uploaded in enumerate(uploaded_files):
+        if uploaded.name.lower().endswith(".zip"):
+            root = roots[archive_index]
+            archive_index += 1
+            archive = spool_upload(uploaded, spool_dir, index) if spool_dir else uploaded
+            if not spool_dir:
+                uploaded.seek(0)
+            try:
+                zf = _zip_for(archive)
+            except Exception as e:
+                log.append(f"❌ Ошибка открытия архива {uploaded.name}: {e}")
+                continue
+            manifest = ArchiveManifest(uploaded.name, root)
+            for info in iter_zip_images(zf):
+                name = _member_name(info, root, log, uploaded.name)
+                if name is None:
+                    continue
+                manifest.sources.append(ImageSource(name, archive=archive, member=info.filename, size=info.file_size))
+            log.append(f"📦 Архив {uploaded.name}: найдено {len(manifest.sources)} изображений.")
+            manifests.append(manifest)
+        elif uploaded.name.lower().endswith(SUPPORTED_EXTS):
+            if spool_dir:
+                path = spool_upload(uploaded, spool_dir, index)
+                loose.sources.append(ImageSource(uploaded.name, path=path, size=os.path.getsize(path)))
+            else:
+                loose.sources.append(ImageSource(uploaded.name, fileobj=uploaded, size=len(uploaded.getvalue())))
+            log.append(f"🖼️ Файл {uploaded.name}: добавлен.")
+        else:
+            log.append(f"❌ {uploaded.name}: не поддерживается.")
+    if loose.sources:
+        manifests.append(loose)
+    return manifests
+
+
+def _flatten(manifests, log):
+    """Список изображений из манифестов; повторяющиеся пути пропускаются, чтобы каждое изображение попало один раз."""
+    sources = []
+    seen = set()
+    for manifest in manifests:
+        for source in manifest.sources:
+            if source.name in seen:
+                log.append(f"⚠️ {source.name}: уже добавлен, повтор пропущен.")
+                continue
+            seen.add(source.name)
+            sources.append(source)
+    return sources
+
+
+def collect_images(uploaded_files, log, spool_dir=None):
+    """
+    Собирает изображения из загруженных файлов и ZIP-архивов без распаковки.
+    Архивы фильтруются по SUPPORTED_EXTS из центрального каталога, прочие члены не читаются.
+    Каждое изображение попадает в список ровно один раз: повторяющиеся пути пропускаются.
+    :param uploaded_files: Загруженные файлы (объекты с .name, .read(), .seek())
+    :param log: Список строк лога, дополняется
+    :param spool_dir: Если задан, загрузки один раз записываются сюда, чтобы источники можно было
+                      передать в процессы-воркеры; иначе источники ссылаются на сами объекты загрузок
+    :return: Список ImageSource
+    """
+    return _flatten(collect_manifests(uploaded_files, log, spool_dir), log)
+
+
+def collect_paths(paths, log):
+    """
+    То же для путей на диске (CLI): папки обходятся рекурсивно, ZIP-архивы читаются
+    без распаковки прямо с диска, отдельные файлы добавляются как есть.
+    :return: Список ImageSource
+    """
+    grouped = [p for p in paths if os.path.isdir(p) or p.lower().endswith(".zip")]
+    roots = dict(zip(grouped, _unique_roots([os.path.basename(os.path.normpath(p)) for p in grouped])))
+    manifests = []
+    loose = ArchiveManifest("")
+    for path in paths:
+        if os.path.isdir(path):
+            root = roots[path]
+            manifest = ArchiveManifest(path, root)
+            for file in sorted(Path(path).rglob("*")):
+                if file.is_file() and file.suffix.lower() in SUPPORTED_EXTS:
+                    rel = file.relative_to(path).as_posix()
+                    name = str(PurePosixPath(root, rel)) if root else rel
+                    manifest.sources.append(ImageSource(name, path=str(file), size=file.stat().st_size))
+            log.append(f"📁 Папка {path}: найдено {len(manifest.sources)} изображений.")
+            manifests.append(manifest)
+        elif path.lower().endswith(".zip"):
+            root = roots[path]
+            try:
+                zf = _zip_for(path)
+            except Exception as e:
+                log.append(f"❌ Ошибка открытия архива {path}: {e}")
+                continue
+            manifest = ArchiveManifest(path, root)
+            for info in iter_zip_images(zf):
+                name = _member_name(info, root, log, path)
+                if name is None:
+                    continue
+                manifest.sources.append(ImageSource(name, archive=path, member=info.filename, size=info.file_size))
+            log.append(f"📦 Архив {path}: найдено {len(manifest.sources)} изображений.")
+            manifests.append(manifest)
+        elif path.lower().endswith(SUPPORTED_EXTS) and os.path.isfile(path):
+            loose.sources.append(ImageSource(os.path.basename(path), path=path, size=os.path.getsize(path)))
+            log.append(f"🖼️ Файл {path}: добавлен.")
+        else:
+            log.append(f"❌ {path}: не поддерживается.")
+    if loose.sources:
+        manifests.append(loose)
+    return _flatten(manifests, log)
+
+
+def close_archives():
+    """Закрывает все архивы, открытые в этом потоке (после завершения пакета)."""
+    zips = _open_zips()
+    while zips:
+        _, (_, zf) = zips.popitem()
+        zf.close()
+
+
+def map_chunked(func, items, threads, name="photoflow"):
+    """
+    Применяет func к каждому элементу в пуле потоков, по одной непрерывной части списка на поток:
+    у каждого потока свои дескрипторы ZIP-архивов, и после своей части поток их закрывает.
+    Для работы, которая упирается в чтение (заголовки, хэши), а не в процессор.
+    :param name: Префикс имён потоков
+    :return: Результаты func в порядке items
+    """
+    if not items:
+        return []
+    threads = max(1, min(threads, len(items)))
+    step = -(-len(items) // threads)
+    chunks = [items[i:i + step] for i in range(0, len(items), step)]
+
+    def run(chunk):
+        try:
+            return [func(item) for item in chunk]
+        finally:
+            close_archives()
+
+    with ThreadPoolExecutor(max_workers=len(chunks), thread_name_prefix=name) as pool:
+        return [value for chunk in pool.map(run, chunks) for value in chunk]
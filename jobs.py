@@ -0,0 +1,334 @@
+# jobs.py
+# Фоновые задания обработки. Пакет выполняется в потоке сервера, а не в обработчике кнопки,
+# поэтому перезапуск скрипта или закрытие вкладки его не прерывают. Состояние задания
+# пишется в state.json его папки, интерфейс только опрашивает его по ID. Описание задания
+# (job.json) и контрольная точка (checkpoint.py) позволяют продолжить прерванное задание.
+import os
+import json
+import time
+import uuid
+import shutil
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from utils import WORK_ROOT, MAX_WORKERS, SESSION_TTL_SECONDS
+from archive import ResultArchive
+from ingest import ImageSource, collect_images, close_archives
+from metrics import BatchMetrics
+from checkpoint import Checkpoint, batch_key
+
+JOBS_ROOT = os.path.join(WORK_ROOT, "jobs")
+# Как часто (сек) записывать прогресс в state.json
+STATE_WRITE_INTERVAL = 0.5
+# Статусы, после которых задание больше не меняется (ошибку можно продолжить через resume_job)
+FINISHED = ("done", "error")
+# Квота на папки заданий на диске (переопределяется PHOTOFLOW_JOBS_MB)
+JOBS_MAX_BYTES = int(os.environ.get("PHOTOFLOW_JOBS_MB", 10240)) * 1024 * 1024
+
+
+class WorkerBudget:
+    """
+    Общий для всех сессий сервера бюджет процессов-воркеров. Задание берёт столько,
+    сколько просило, но не больше свободного; если свободных нет — ждёт в очереди.
+    """
+
+    def __init__(self, total):
+        self.total = total
+        self.free = total
+        self._cond = threading.Condition()
+
+    def acquire(self, requested):
+        with self._cond:
+            while self.free < 1:
+                self._cond.wait()
+            granted = max(1, min(requested, self.free))
+            self.free -= granted
+            return granted
+
+    def release(self, granted):
+        with self._cond:
+            self.free += granted
+            self._cond.notify_all()
+
+
+_budget = WorkerBudget(MAX_WORKERS)
+# Потоков не больше бюджета: каждое выполняющееся задание занимает хотя бы один воркер
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="photoflow-job")
+# Задания, которые выполняются или ждут в этом процессе сервера
+_active = set()
+_active_lock = threading.Lock()
+
+
+def job_dir(job_id):
+    return os.path.join(JOBS_ROOT, job_id)
+
+
+def _state_path(job_id):
+    return os.path.join(job_dir(job_id), "state.json")
+
+
+def _write_state(job_id, state):
+    """Атомарная запись состояния: читатель никогда не видит недописанный файл."""
+    state["updated"] = time.time()
+    tmp = _state_path(job_id) + ".part"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp, _state_path(job_id))
+
+
+def _spec_path(job_id):
+    return os.path.join(job_dir(job_id), "job.json")
+
+
+def _read_state(job_id):
+    try:
+        with open(_state_path(job_id), encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def new_job(session_id, mode):
+    """
+    Создаёт папку задания (в неё же кладутся загрузки и результат) и пишет начальное состояние.
+    :return: ID задания
+    """
+    job_id = uuid.uuid4().hex
+    os.makedirs(job_dir(job_id), exist_ok=True)
+    _write_state(job_id, {
+        "id": job_id, "session_id": session_id, "mode": mode, "status": "new",
+        "done": 0, "total": 0, "created": time.time(),
+    })
+    return job_id
+
+
+def discard_job(job_id):
+    """Удаляет задание, которое так и не было поставлено в очередь (например, без изображений)."""
+    shutil.rmtree(job_dir(job_id), ignore_errors=True)
+
+
+def load_state(job_id):
+    """
+    Состояние задания или None, если его нет. Задание, которое числится незавершённым,
+    но не выполняется в этом процессе (сервер перезапускался), помечается как прерванное.
+    """
+    state = _read_state(job_id)
+    if state is None:
+        return None
+    if state["status"] not in FINISHED:
+        with _active_lock:
+            lost = job_id not in _active
+        if lost:
+            state.update(status="error", error="Задание прервано: сервер был перезапущен.",
+                         resumable=os.path.exists(_spec_path(job_id)))
+    return state
+
+
+def load_log(job_id):
+    try:
+        with open(os.path.join(job_dir(job_id), "log.txt"), encoding="utf-8") as f:
+            return f.read().splitlines()
+    except OSError:
+        return []
+
+
+def submit(job_id, mode, sources, log, metrics, workers, params):
+    """
+    Ставит пакет в очередь. Источники к этому моменту должны ссылаться только на файлы
+    в папке задания (загрузки записаны на диск), а не на объекты загрузок сессии.
+    :param mode: "rename", "convert", "watermark" или "combined"
+    :param sources: Список ImageSource
+    :param log: Начало лога (сбор файлов)
+    :param metrics: BatchMetrics с замером этапа ingest
+    :param workers: Сколько процессов просит задание (выдаётся не больше свободных)
+    :param params: Параметры режима для core.run_* (profile, watermark_path, position, ...)
+    """
+    # Всё, что нужно для повторного запуска после сбоя: загрузки уже лежат в папке задания
+    spec = {"mode": mode, "workers": workers, "params": params, "log": log,
+            "sources": [src.as_dict() for src in sources]}
+    with open(_spec_path(job_id), "w", encoding="utf-8") as f:
+        json.dump(spec, f, ensure_ascii=False)
+    _enqueue(job_id, _read_state(job_id), mode, sources, log, metrics, workers, params)
+
+
+def resume_job(job_id):
+    """
+    Снова ставит в очередь задание, прерванное ошибкой или перезапуском сервера. Загрузки и недописанный
+    архив результата остались в папке задания: уже обработанные изображения не обрабатываются заново.
+    :return: True, если задание поставлено в очередь
+    """
+    state = load_state(job_id)
+    if state is None or state["status"] != "error" or not state.get("resumable"):
+        return False
+    try:
+        with open(_spec_path(job_id), encoding="utf-8") as f:
+            spec = json.load(f)
+    except (OSError, ValueError):
+        return False
+    sources = [ImageSource(**src) for src in spec["sources"]]
+    state.pop("error", None)
+    state.update(resumed=state.get("resumed", 0) + 1, done=0)
+    _enqueue(job_id, state, spec["mode"], sources, list(spec["log"]), BatchMetrics(spec["mode"]),
+             spec["workers"], spec["params"])
+    return True
+
+
+def _enqueue(job_id, state, mode, sources, log, metrics, workers, params):
+    state.update(status="queued", total=len(sources))
+    with _active_lock:
+        _active.add(job_id)
+    _write_state(job_id, state)
+    _executor.submit(_run, job_id, state, mode, sources, log, metrics, workers, params)
+
+
+def _job_watermark(job_id, params):
+    """
+    Параметры с копией картинки водяного знака в папке задания: сессия может удалить свой файл,
+    пока задание в очереди. Знак — params["watermark_path"] (watermark) или
+    params["watermark"]["watermark_path"] (combined).
+    """
+    params = dict(params)
+    if params.get("watermark_path"):
+        params["watermark_path"] = shutil.copy(params["watermark_path"], job_dir(job_id))
+    watermark = params.get("watermark")
+    if watermark and watermark.get("watermark_path"):
+        params["watermark"] = dict(watermark, watermark_path=shutil.copy(watermark["watermark_path"], job_dir(job_id)))
+    return params
+
+
+def start_job(session_id, mode, uploaded_files, params, workers=MAX_WORKERS):
+    """
+    Создаёт задание из загрузок сессии и ставит его в очередь. Архивы читаются без распаковки,
+    загрузки пишутся в папку задания. Если поддерживаемых изображений нет, задание удаляется.
+    :param params: Параметры режима для core.run_* (см. submit)
+    :return: (ID задания или None, лог сбора файлов, число изображений)
+    """
+    job_id = new_job(session_id, mode)
+    log = []
+    metrics = BatchMetrics(mode)
+    with metrics.stage("ingest"):
+        sources = collect_images(uploaded_files, log, spool_dir=job_dir(job_id))
+    close_archives()
+    if not sources:
+        discard_job(job_id)
+        return None, log, 0
+    submit(job_id, mode, sources, log, metrics, workers, _job_watermark(job_id, params))
+    return job_id, log, len(sources)
+
+
+def _process(mode, sources, result, log, metrics, workers, work_dir, on_progress, params, checkpoint):
+    # Обработка (PIL, пул процессов) импортируется при первом задании, а не при загрузке страницы,
+    # которой нужно только состояние заданий
+    from core import run_rename, run_convert, run_watermark, run_combined
+    from result_cache import default_cache
+    if mode == "rename":
+        return run_rename(sources, result, log, on_progress=on_progress, metrics=metrics, **params)
+    if mode == "combined":
+        return run_combined(sources, result, log, workers=workers, work_dir=work_dir, on_progress=on_progress,
+                            metrics=metrics, checkpoint=checkpoint, **params)
+    runner = run_convert if mode == "convert" else run_watermark
+    return runner(sources, result, log, workers=workers, work_dir=work_dir, on_progress=on_progress,
+                  metrics=metrics, cache=default_cache(), checkpoint=checkpoint, **params)
+
+
+def _run(job_id, state, mode, sources, log, metrics, workers, params):
+    """Выполняется в потоке пула заданий."""
+    granted = _budget.acquire(workers)
+    last_write = 0.0
+
+    def on_progress(done, total):
+        nonlocal last_write
+        state.update(done=done, total=total)
+        now = time.perf_counter()
+        if now - last_write >= STATE_WRITE_INTERVAL or done == total:
+            last_write = now
+            _write_state(job_id, state)
+
+    try:
+        state.update(status="running", workers=granted, started=time.time())
+        _write_state(job_id, state)
+        result_zip = os.path.join(job_dir(job_id), f"result_{mode}.zip")
+        # Переименование только копирует файлы — его проще повторить целиком
+        checkpoint = Checkpoint(job_dir(job_id), batch_key(mode, params, sources)) if mode != "rename" else None
+        resume = checkpoint.archive_state(result_zip) if checkpoint else None
+        with ResultArchive(result_zip, resume=resume) as archive:
+            stats = _process(mode, sources, archive, log, metrics, granted, job_dir(job_id), on_progress, params,
+                             checkpoint)
+            if mode == "convert" and not stats["converted"]:
+                # Архив только с логом ошибок
+                archive.add_bytes("\n".join(log), "log.txt")
+        stats["perf"] = metrics.summary()
+        state.update(status="done", result_zip=result_zip, stats=stats)
+        state.pop("resumable", None)
+    except Exception as e:
+        log.append(f"Ошибка обработки: {e}")
+        state.update(status="error", error=str(e), resumable=True)
+    finally:
+        close_archives()
+        _budget.release(granted)
+        if state["status"] == "done":
+            # Загрузки больше не нужны — в папке задания остаются результат, лог и состояние.
+            # После ошибки они остаются для resume_job
+            shutil.rmtree(os.path.join(job_dir(job_id), "_uploads"), ignore_errors=True)
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(_spec_path(job_id))
+        with open(os.path.join(job_dir(job_id), "log.txt"), "w", encoding="utf-8") as f:
+            f.write("\n".join(log))
+        _write_state(job_id, state)
+        with _active_lock:
+            _active.discard(job_id)
+
+
+def _dir_size(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            with contextlib.suppress(OSError):
+                total += os.path.getsize(os.path.join(dirpath, name))
+    return total
+
+
+def cleanup_stale_jobs(max_age=SESSION_TTL_SECONDS, max_bytes=JOBS_MAX_BYTES):
+    """
+    Удаляет папки заданий (вместе с контрольными точками прерванных), не менявшиеся дольше
+    max_age секунд, затем — самые давние, пока все задания не уложатся в квоту max_bytes.
+    По квоте удаляются только завершённые задания: незавершённые (в том числе ещё собирающие
+    загрузки до submit) и задания без читаемого state.json не удаляются, но их размер учитывается.
+    :return: (удалено папок, освобождено байт)
+    """
+    if not os.path.isdir(JOBS_ROOT):
+        return 0, 0
+    now = time.time()
+    entries = []
+    total = 0
+    removed = 0
+    freed = 0
+    for name in os.listdir(JOBS_ROOT):
+        path = os.path.join(JOBS_ROOT, name)
+        with _active_lock:
+            active = name in _active
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            continue
+        size = _dir_size(path)
+        state = _read_state(name)
+        if active:
+            total += size
+        elif now - mtime > max_age:
+            shutil.rmtree(path, ignore_errors=True)
+            removed += 1
+            freed += size
+        elif state is None or state.get("status") not in FINISHED:
+            total += size
+        else:
+            entries.append((mtime, size, path))
+            total += size
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        removed += 1
+        freed += size
+    return removed, freed
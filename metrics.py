@@ -0,0 +1,97 @@
+# metrics.py
+# Лёгкие замеры этапов обработки (perf_counter) и их сводка по пакету.
+import math
+import time
+import contextlib
+from utils import HEIF_EXTS
+
+
+def decode_stage(suffix):
+    """Имя этапа декодирования: HEIC/HEIF учитываются отдельно от остальных форматов."""
+    return "decode_heic" if suffix in HEIF_EXTS else "decode"
+
+
+class StageTimer:
+    """
+    Длительности и объёмы данных по этапам обработки одного изображения.
+    Результат as_dict() передаётся из процесса-воркера в основной процесс.
+    """
+
+    def __init__(self):
+        self.stages = {}
+
+    def add(self, name, seconds, nbytes=0):
+        total = self.stages.setdefault(name, [0.0, 0])
+        total[0] += seconds
+        total[1] += nbytes
+
+    @contextlib.contextmanager
+    def stage(self, name, nbytes=0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, nbytes)
+
+    def as_dict(self):
+        return {name: (seconds, nbytes) for name, (seconds, nbytes) in self.stages.items()}
+
+
+def _percentile(values, q):
+    """Перцентиль по ближайшему рангу: ceil(q/100 * n)-е значение (values уже отсортированы)."""
+    if not values:
+        return 0.0
+    index = max(0, math.ceil(q / 100.0 * len(values)) - 1)
+    return values[index]
+
+
+class BatchMetrics:
+    """
+    Сводка замеров по пакету: для каждого этапа — число замеров, сумма, p50/p95 и байты,
+    а также общая скорость (изображений в секунду).
+    :param mode: Имя режима (rename, convert, watermark)
+    """
+
+    def __init__(self, mode):
+        self.mode = mode
+        self.images = 0
+        self._samples = {}
+        self._bytes = {}
+        self._start = time.perf_counter()
+
+    def add(self, name, seconds, nbytes=0):
+        self._samples.setdefault(name, []).append(seconds)
+        self._bytes[name] = self._bytes.get(name, 0) + nbytes
+
+    def add_stages(self, stages):
+        """Добавляет замеры одного изображения (StageTimer.as_dict() из воркера)."""
+        for name, (seconds, nbytes) in stages.items():
+            self.add(name, seconds, nbytes)
+
+    @contextlib.contextmanager
+    def stage(self, name, nbytes=0):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, nbytes)
+
+    def summary(self):
+        wall = time.perf_counter() - self._start
+        stages = {}
+        for name, samples in self._samples.items():
+            ordered = sorted(samples)
+            stages[name] = {
+                "count": len(ordered),
+                "total": round(sum(ordered), 4),
+                "p50": round(_percentile(ordered, 50), 4),
+                "p95": round(_percentile(ordered, 95), 4),
+                "bytes": self._bytes.get(name, 0),
+            }
+        return {
+            "mode": self.mode,
+            "images": self.images,
+            "wall_time": round(wall, 3),
+            "images_per_sec": round(self.images / wall, 2) if wall > 0 else 0.0,
+            "stages": stages,
+        }
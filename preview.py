@@ -0,0 +1,113 @@
+# preview.py
+import os
+import hashlib
+import zipfile
+from io import BytesIO
+from PIL import Image
+import streamlit as st
+from utils import SUPPORTED_EXTS, ensure_heif_support
+from ingest import iter_zip_images
+from imaging import apply_watermark, TILE_SPACING, TILE_ANGLE
+
+# Размер уменьшенной копии для предпросмотра (по длинной стороне)
+PREVIEW_MAX_SIDE = 1280
+# Сколько готовых предпросмотров (JPEG, ~сотни КБ каждый) держать в кэше
+PREVIEW_CACHE_ENTRIES = 48
+
+
+def file_digest(uploaded):
+    """
+    Хэш содержимого загруженного файла. Считается один раз на загрузку
+    и запоминается в session_state по file_id, чтобы не хэшировать файл на каждом перезапуске.
+    """
+    digests = st.session_state.setdefault("_file_digests", {})
+    key = getattr(uploaded, "file_id", None) or uploaded.name
+    if key not in digests:
+        digests[key] = hashlib.blake2b(uploaded.getvalue(), digest_size=16).hexdigest()
+    return digests[key]
+
+
+def decode_proxy(fp, max_side=PREVIEW_MAX_SIDE):
+    """
+    Декодирует уменьшенную копию изображения. Для JPEG draft() включает масштабирование
+    прямо в декодере, для HEIF — использует встроенную миниатюру подходящего размера.
+    """
+    img = Image.open(fp)
+    img.draft("RGB", (max_side, max_side))
+    img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+    return img.convert("RGB")
+
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def _cached_proxy(digest, name, _data):
+    """Уменьшенная копия первого изображения загрузки; кэшируется по хэшу файла."""
+    ensure_heif_support()
+    if name.lower().endswith(".zip"):
+        with zipfile.ZipFile(BytesIO(_data), "r") as zf:
+            for info in iter_zip_images(zf):
+                try:
+                    with zf.open(info) as imgf:
+                        return decode_proxy(BytesIO(imgf.read()))
+                except Exception:
+                    continue
+        return None
+    try:
+        return decode_proxy(BytesIO(_data))
+    except Exception:
+        return None
+
+
+def get_preview_image(uploaded_files):
+    """
+    Уменьшенная копия первого поддерживаемого изображения из загрузок.
+    :return: (изображение, хэш файла) или (None, None)
+    """
+    for file in uploaded_files:
+        name = file.name.lower()
+        if name.endswith(SUPPORTED_EXTS) or name.endswith(".zip"):
+            digest = file_digest(file)
+            proxy = _cached_proxy(digest, file.name, file.getvalue())
+            if proxy is not None:
+                return proxy, digest
+    return None, None
+
+
+def save_user_watermark(user_wm_file, directory):
+    """
+    Сохраняет загруженный пользователем водяной знак в directory под именем по хэшу
+    содержимого. Файл пишется только один раз, а не на каждом перезапуске скрипта.
+    """
+    ext = os.path.splitext(user_wm_file.name)[1].lower()
+    path = os.path.join(directory, f"user_wm_{file_digest(user_wm_file)}{ext}")
+    if not os.path.exists(path):
+        with open(path, "wb") as f:
+            f.write(user_wm_file.getvalue())
+    return path
+
+
+@st.cache_data(max_entries=PREVIEW_CACHE_ENTRIES, show_spinner=False)
+def _cached_render(image_key, wm_key, position, opacity, scale, tile_spacing, tile_angle, text, text_options,
+                   _image, _watermark_path):
+    """Готовый предпросмотр в JPEG — кэш ограничен по числу записей и занимает мало памяти."""
+    preview = apply_watermark(_image, watermark_path=_watermark_path, text=text, position=position, opacity=opacity,
+                              scale=scale, tile_spacing=tile_spacing, tile_angle=tile_angle, text_options=text_options)
+    buf = BytesIO()
+    preview.save(buf, "JPEG", quality=90)
+    return buf.getvalue()
+
+
+def render_preview(image, image_key, watermark_path, position, opacity, scale,
+                   tile_spacing=TILE_SPACING, tile_angle=TILE_ANGLE, text=None, text_options=None):
+    """
+    Предпросмотр с водяным знаком, кэшированный по (хэш фото, водяной знак, положение,
+    прозрачность, масштаб, параметры плитки): при переключении между уже виденными настройками
+    результат возвращается сразу, без повторного наложения.
+    :param watermark_path: Картинка водяного знака; None — текстовый знак text
+    :return: JPEG-байты для st.image
+    """
+    wm_key = None
+    if watermark_path:
+        stat = os.stat(watermark_path)
+        wm_key = (os.path.abspath(watermark_path), stat.st_mtime_ns, stat.st_size)
+    return _cached_render(image_key, wm_key, position, opacity, scale, tile_spacing, tile_angle, text, text_options,
+                          image, watermark_path)
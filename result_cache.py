@@ -0,0 +1,145 @@
+# result_cache.py
+# Кэш готовых результатов по содержимому: повторная обработка того же изображения с теми же
+# параметрами берёт готовый JPEG с диска вместо декодирования, наложения и кодирования.
+import os
+import shutil
+import hashlib
+import uuid
+import PIL
+from utils import WORK_ROOT
+from metrics import StageTimer
+
+CACHE_DIR = os.path.join(WORK_ROOT, "cache")
+# Бюджет кэша на диске (переопределяется PHOTOFLOW_CACHE_MB; 0 — кэш выключен)
+CACHE_MAX_BYTES = int(os.environ.get("PHOTOFLOW_CACHE_MB", 2048)) * 1024 * 1024
+HASH_CHUNK = 1024 * 1024
+
+
+def file_digest(path):
+    """Хэш содержимого файла на диске (например, водяного знака) для ключа кэша."""
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def source_digest(src):
+    """Хэш содержимого ImageSource; члены архивов читаются потоком, без временных копий."""
+    h = hashlib.blake2b(digest_size=16)
+    with src.open(materialize=False) as fp:
+        for chunk in iter(lambda: fp.read(HASH_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def code_version():
+    """
+    Версия кода обработки для ключа кэша: хэш imaging.py и версия Pillow.
+    Любая правка алгоритмов обработки автоматически делает старые записи недействительными.
+    """
+    h = hashlib.blake2b(digest_size=8)
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "imaging.py"), "rb") as f:
+        h.update(f.read())
+    h.update(PIL.__version__.encode())
+    return h.hexdigest()
+
+
+class ResultCache:
+    """
+    Готовые результаты по ключу (хэш входа, режим, параметры, версия кода) в папке на диске.
+    Объект передаётся в процессы-воркеры: поиск и запись выполняются там же, где обработка.
+    Вытеснение — LRU по времени последнего обращения (mtime обновляется при попадании).
+    :param root: Папка кэша
+    :param max_bytes: Бюджет на диске; trim() удаляет самые старые записи сверх него
+    """
+
+    def __init__(self, root=CACHE_DIR, max_bytes=CACHE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.version = code_version()
+
+    def key(self, digest, mode, params):
+        raw = repr((digest, mode, tuple(params), self.version)).encode()
+        return hashlib.blake2b(raw, digest_size=20).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.root, key[:2], key + ".jpg")
+
+    def get(self, key, dst):
+        """Копирует результат из кэша в dst. :return: True при попадании"""
+        path = self._path(key)
+        try:
+            os.utime(path)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            shutil.copyfile(path, dst)
+        except FileNotFoundError:
+            # Записи нет или её только что вытеснил другой процесс
+            return False
+        return True
+
+    def put(self, key, src):
+        """Сохраняет готовый файл src в кэш (атомарно: через временное имя)."""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{uuid.uuid4().hex}.part"
+        shutil.copyfile(src, tmp)
+        os.replace(tmp, path)
+
+    def trim(self):
+        """
+        Удаляет самые давно использованные записи, пока кэш не уложится в бюджет.
+        :return: (удалено записей, освобождено байт)
+        """
+        entries = []
+        total = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+        removed = 0
+        freed = 0
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+            freed += size
+        return removed, freed
+
+
+def default_cache():
+    """Кэш с настройками по умолчанию или None, если он выключен (PHOTOFLOW_CACHE_MB=0)."""
+    return ResultCache() if CACHE_MAX_BYTES > 0 else None
+
+
+def cached_call(func, cache, mode, params, src, dst, *args):
+    """
+    Выполняется в процессе-воркере: берёт результат func(src, dst, *args) из кэша или
+    вычисляет его и сохраняет в кэш. Ключ — хэш содержимого src, режим и параметры params.
+    :return: dict от func (или эквивалент для попадания) с флагом "cached"
+    """
+    timer = StageTimer()
+    with timer.stage("hash", src.size):
+        key = cache.key(source_digest(src), mode, params)
+    with timer.stage("cache"):
+        hit = cache.get(key, dst)
+    if hit:
+        bytes_out = os.path.getsize(dst)
+        return {"bytes_in": src.size, "bytes_out": bytes_out, "encode_time": 0.0,
+                "stages": timer.as_dict(), "cached": True}
+    value = func(src, dst, *args)
+    with timer.stage("cache"):
+        cache.put(key, dst)
+    value["stages"].update(timer.as_dict())
+    value["cached"] = False
+    return value
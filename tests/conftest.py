@@ -0,0 +1,6 @@
+# conftest.py
+# Модули PhotoFlow лежат в корне репозитория и импортируются абсолютными именами
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,44 @@
+# test_batch.py
+import os
+from batch import run_batch
+
+
+def square(x):
+    return x * x
+
+
+def crash_on_three(x):
+    # Процесс-воркер завершается целиком, как при падении декодера
+    if x == 3:
+        os._exit(1)
+    return x * x
+
+
+def _collect(func, count, workers):
+    results = []
+    progress = []
+    done = run_batch(func, [(i,) for i in range(count)], workers=workers, max_in_flight=4,
+                     on_result=lambda i, job, value, error, elapsed: results.append((i, value, error)),
+                     on_progress=lambda n, total: progress.append((n, total)))
+    return done, results, progress
+
+
+def test_results_in_order():
+    done, results, progress = _collect(square, 20, workers=2)
+    assert done == 20
+    assert [(i, value) for i, value, _ in results] == [(i, i * i) for i in range(20)]
+    assert all(error is None for _, _, error in results)
+    assert progress[-1] == (20, 20)
+
+
+def test_crashed_worker_turns_remaining_jobs_into_errors():
+    done, results, progress = _collect(crash_on_three, 20, workers=2)
+    assert done == 20
+    assert [i for i, _, _ in results] == list(range(20))
+    # Задания, которые были в работе вместе с упавшим, тоже могут потеряться
+    assert all(value == i * i for i, value, _ in results if value is not None)
+    assert results[3][2] is not None
+    # Всё, что не успело выполниться до падения, — ошибки отдельных файлов, а не исключение пакета
+    assert all(error is not None for _, value, error in results if value is None)
+    assert results[-1][2] is not None
+    assert progress[-1] == (20, 20)
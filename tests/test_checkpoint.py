@@ -0,0 +1,42 @@
+# test_checkpoint.py
+import shutil
+import zipfile
+from archive import ResultArchive
+from checkpoint import Checkpoint
+
+
+def test_archive_resumes_after_last_mark(tmp_path):
+    path = str(tmp_path / "result.zip")
+    checkpoint = Checkpoint(str(tmp_path / "work"), "key")
+    checkpoint.completed()
+    archive = ResultArchive(path)
+    archive.add_bytes(b"first" * 100, "1.png")
+    archive.add_bytes(b"jpeg", "1.jpg")
+    checkpoint.mark(0, {"bytes_out": 4}, archive=archive.checkpoint_state())
+    # Запись после отметки и без центрального каталога — как при аварийном завершении
+    archive.add_bytes(b"lost", "2.jpg")
+    archive._zip.fp.flush()
+    shutil.copyfile(path, path + ".crashed")
+    archive.close()
+    shutil.move(path + ".crashed", path)
+
+    resumed = Checkpoint(str(tmp_path / "work"), "key")
+    assert resumed.completed() == {0: ({"bytes_out": 4, "stages": {}}, None)}
+    with ResultArchive(path, resume=resumed.archive_state(path)) as archive:
+        assert archive.count == 2
+        archive.add_bytes(b"second", "2.jpg")
+    with zipfile.ZipFile(path) as zf:
+        assert zf.testzip() is None
+        assert zf.namelist() == ["1.png", "1.jpg", "2.jpg"]
+        assert zf.read("1.png") == b"first" * 100
+        assert zf.read("2.jpg") == b"second"
+
+
+def test_missing_archive_restarts_batch(tmp_path):
+    work = str(tmp_path / "work")
+    checkpoint = Checkpoint(work, "key")
+    checkpoint.completed()
+    checkpoint.mark(0, {}, archive={"end": 100, "entries": []})
+    resumed = Checkpoint(work, "key")
+    assert resumed.archive_state(str(tmp_path / "result.zip")) is None
+    assert resumed.completed() == {}
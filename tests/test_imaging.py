@@ -0,0 +1,31 @@
+# test_imaging.py
+import os
+from PIL import Image, ImageCms
+from ingest import ImageSource
+from imaging import convert_file, multi_output_file
+
+
+def _source(tmp_path, mode, icc_profile):
+    path = str(tmp_path / f"{mode}.jpg")
+    Image.new(mode, (64, 48)).save(path, "JPEG", icc_profile=icc_profile)
+    return ImageSource(f"{mode}.jpg", path=path, size=os.path.getsize(path))
+
+
+def test_cmyk_profile_is_dropped(tmp_path):
+    # Заголовок профиля: пространство данных в байтах 16-20
+    cmyk_profile = bytes(16) + b"CMYK" + bytes(108)
+    src = _source(tmp_path, "CMYK", cmyk_profile)
+    convert_file(src, str(tmp_path / "out" / "convert.jpg"))
+    multi_output_file(src, {"thumbnail": str(tmp_path / "out" / "thumb.jpg")})
+    for name in ("convert.jpg", "thumb.jpg"):
+        with Image.open(tmp_path / "out" / name) as img:
+            assert img.mode == "RGB"
+            assert img.info.get("icc_profile") is None
+
+
+def test_rgb_profile_is_kept(tmp_path):
+    srgb = ImageCms.ImageCmsProfile(ImageCms.createProfile("sRGB")).tobytes()
+    src = _source(tmp_path, "RGB", srgb)
+    convert_file(src, str(tmp_path / "out" / "convert.jpg"))
+    with Image.open(tmp_path / "out" / "convert.jpg") as img:
+        assert img.info.get("icc_profile") == srgb
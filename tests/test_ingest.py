@@ -0,0 +1,16 @@
+# test_ingest.py
+import threading
+from ingest import map_chunked
+
+
+def test_map_chunked_keeps_order():
+    names = set()
+
+    def square(x):
+        names.add(threading.current_thread().name)
+        return x * x
+
+    assert map_chunked(square, list(range(50)), threads=4, name="test-chunk") == [x * x for x in range(50)]
+    assert 1 <= len(names) <= 4 and all(name.startswith("test-chunk") for name in names)
+    assert map_chunked(square, [3], threads=8) == [9]
+    assert map_chunked(square, [], threads=8) == []
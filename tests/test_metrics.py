@@ -0,0 +1,10 @@
+# test_metrics.py
+from metrics import _percentile
+
+
+def test_percentile_nearest_rank():
+    assert _percentile(list(range(1, 11)), 50) == 5
+    assert _percentile(list(range(1, 101)), 95) == 95
+    assert _percentile([1, 2], 50) == 1
+    assert _percentile([7], 95) == 7
+    assert _percentile([], 50) == 0.0
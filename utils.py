@@ -1,6 +1,57 @@
+import os
+import time
+import shutil
+import tempfile
+import importlib.util
+
 SUPPORTED_EXTS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp', '.tiff', '.heic', '.heif')
+# Семейства форматов, которые читаются по-своему (декодирование HEIF, заголовки EXIF)
+JPEG_EXTS = ('.jpg', '.jpeg')
+HEIF_EXTS = ('.heic', '.heif')
+TIFF_EXTS = ('.tiff', '.tif')
 MAX_SIZE_MB = 400
 MAX_SIZE_BYTES = MAX_SIZE_MB * 1024 * 1024
+# Число процессов для пакетной обработки (переопределяется переменной окружения PHOTOFLOW_WORKERS)
+MAX_WORKERS = int(os.environ.get("PHOTOFLOW_WORKERS", 0)) or os.cpu_count() or 1
+# Корневая папка для файлов сессий (архивы результатов) и время их жизни
+WORK_ROOT = os.path.join(tempfile.gettempdir(), "photoflow")
+SESSION_TTL_SECONDS = 24 * 60 * 60
+
+# Потоков декодирования HEIF (libheif) на процесс; 0 — подобрать по числу ядер и процессов пула
+HEIF_DECODE_THREADS = int(os.environ.get("PHOTOFLOW_HEIF_THREADS", 0))
+
+_heif_registered = False
+
+def _heif_decode_threads():
+    if HEIF_DECODE_THREADS:
+        return HEIF_DECODE_THREADS
+    import multiprocessing
+    cpus = os.cpu_count() or 1
+    # В процессе-воркере ядра уже поделены между процессами пула
+    if multiprocessing.parent_process() is not None:
+        return max(1, cpus // MAX_WORKERS)
+    return cpus
+
+def heif_available():
+    """Установлен ли pillow-heif — без его импорта (библиотека загружается только для HEIC/HEIF)."""
+    return _heif_registered or importlib.util.find_spec("pillow_heif") is not None
+
+def ensure_heif_support():
+    """Регистрирует pillow-heif в текущем процессе (в том числе в процессах-воркерах пула)."""
+    global _heif_registered
+    if _heif_registered:
+        return True
+    try:
+        import pillow_heif
+    except ImportError:
+        return False
+    pillow_heif.register_heif_opener()
+    # Карты глубины и вспомогательные изображения не используются — не читаем их при открытии
+    pillow_heif.options.DEPTH_IMAGES = False
+    pillow_heif.options.AUX_IMAGES = False
+    pillow_heif.options.DECODE_THREADS = _heif_decode_threads()
+    _heif_registered = True
+    return True
 
 def filter_large_files(uploaded_files, st=None):
     filtered = []
@@ -13,4 +64,27 @@ def filter_large_files(uploaded_files, st=None):
                 st.error(f"Файл {f.name} превышает {MAX_SIZE_MB} МБ и не будет обработан.")
         else:
             filtered.append(f)
-    return filtered 
\ No newline at end of file
+    return filtered 
+
+def session_dir(session_id):
+    """Папка сессии для архива результата; создаётся при первом обращении."""
+    path = os.path.join(WORK_ROOT, "sessions", session_id)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+def remove_session_dir(session_id):
+    shutil.rmtree(os.path.join(WORK_ROOT, "sessions", session_id), ignore_errors=True)
+
+def cleanup_stale_sessions(max_age=SESSION_TTL_SECONDS):
+    """Удаляет папки сессий, к которым не обращались дольше max_age секунд."""
+    root = os.path.join(WORK_ROOT, "sessions")
+    if not os.path.isdir(root):
+        return
+    now = time.time()
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        try:
+            if now - os.path.getmtime(path) > max_age:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            continue